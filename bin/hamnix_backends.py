@@ -0,0 +1,460 @@
+import re
+import gc
+import ast
+import time
+import warnings
+from hamnix_logger import setup_logger
+from hamnix_options import requested_options, DEFAULT_OPTIONS
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+logger = setup_logger(__name__)
+
+DEFAULT_HF_MODEL = "deepseek-ai/deepseek-coder-6.7b-instruct"
+DEFAULT_TINY_MODEL = "Qwen/Qwen2-0.5B-Instruct"
+
+class ModelBackend:
+    # Interface every kernel backend implements. A state is an opaque object
+    # holding whatever the backend needs to continue a sequence (for HF models
+    # the KV cache and the logits of the last position).
+    name = None
+    model_id = None
+    eos_token_id = None
+
+    def load(self):
+        pass
+
+    def encode_chat(self, messages):
+        raise NotImplementedError
+
+    def decode_tokens(self, token_ids):
+        raise NotImplementedError
+
+    def prefill(self, token_ids, state=None):
+        raise NotImplementedError
+
+    def sample(self, state):
+        raise NotImplementedError
+
+    def decode(self, state, token):
+        raise NotImplementedError
+
+    def decode_batch(self, states, tokens):
+        return [self.decode(state, token) for state, token in zip(states, tokens)]
+
+    def state_nbytes(self, state):
+        return 0
+
+class HFState:
+    def __init__(self, past_key_values, logits, length, batch=None, row=None):
+        self.past_key_values = past_key_values
+        self.logits = logits
+        self.length = length
+        # The padded batch cache this state is row `row` of, if it came from
+        # decode_batch; past_key_values is then a view into it
+        self.batch = batch
+        self.row = row
+
+class HFBatch:
+    # Left-padded KV cache and attention mask of a decode_batch step, shared
+    # by the states it returned so the next step can run on it as it is
+    def __init__(self, past_key_values, attention_mask, size):
+        self.past_key_values = past_key_values
+        self.attention_mask = attention_mask
+        self.size = size
+
+def sampling_probs(logits, top_k=50, top_p=0.95):
+    # Same sampling settings the kernel has always used with model.generate
+    logits = logits.float()
+    if top_k > 0:
+        top_k = min(top_k, logits.size(-1))
+        kth_value = torch.topk(logits, top_k)[0][..., -1, None]
+        logits = logits.masked_fill(logits < kth_value, float('-inf'))
+    if top_p < 1.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+        cumulative_probs = torch.cumsum(torch.softmax(sorted_logits, dim=-1), dim=-1)
+        sorted_remove = cumulative_probs > top_p
+        # Always keep the most likely token
+        sorted_remove[..., 1:] = sorted_remove[..., :-1].clone()
+        sorted_remove[..., 0] = False
+        remove = sorted_remove.scatter(-1, sorted_indices, sorted_remove)
+        logits = logits.masked_fill(remove, float('-inf'))
+    return torch.softmax(logits, dim=-1)
+
+def sample_token(logits, top_k=50, top_p=0.95):
+    probs = sampling_probs(logits, top_k, top_p)
+    return torch.multinomial(probs, num_samples=1).item()
+
+def to_legacy_cache(past_key_values):
+    # States keep the cache as a tuple of (key, value) per layer so a cached
+    # state is never mutated in place by a later forward pass.
+    if hasattr(past_key_values, 'to_legacy_cache'):
+        return past_key_values.to_legacy_cache()
+    if hasattr(past_key_values, 'layers'):
+        return tuple((layer.keys, layer.values) for layer in past_key_values.layers)
+    return past_key_values
+
+def from_legacy_cache(past_key_values):
+    if past_key_values is None:
+        return None
+    try:
+        from transformers import DynamicCache
+    except ImportError:
+        return past_key_values
+    if hasattr(DynamicCache, 'from_legacy_cache'):
+        return DynamicCache.from_legacy_cache(past_key_values)
+    return DynamicCache(past_key_values)
+
+class HFBackend(ModelBackend):
+    name = 'hf'
+
+    def __init__(self, model=None, device=None, dtype=None, top_k=50, top_p=0.95, quantize=None):
+        self.model_name = model or DEFAULT_HF_MODEL
+        self.device = device
+        self.dtype = dtype
+        self.quantize = quantize
+        self.top_k = top_k
+        self.top_p = top_p
+        self.model_id = f"{self.name}:{self.model_name}"
+        self.model = None
+        self.tokenizer = None
+        # decode_batch steps, and those that had to pad the caches again
+        self.batch_steps = 0
+        self.batch_repads = 0
+        self.repad_seconds = 0.0
+
+    def load(self):
+        if torch is None:
+            raise RuntimeError("The hf backend requires torch and transformers to be installed")
+        from transformers import AutoTokenizer, AutoModelForCausalLM
+        if self.device is None:
+            self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        if isinstance(self.dtype, str):
+            self.dtype = getattr(torch, self.dtype)
+        if self.dtype is None:
+            self.dtype = torch.bfloat16 if self.device.startswith('cuda') else torch.float32
+        logger.debug(f"Loading {self.model_name} on {self.device} as {self.dtype}" + (f", quantized to {self.quantize}" if self.quantize else ""))
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name, trust_remote_code=True)
+        logger.debug("Tokenizer loaded")
+        self.model = self.load_model(AutoModelForCausalLM)
+        self.model.eval()
+        logger.debug(f"Model loaded on {self.device}")
+        self.model.config.pad_token_id = self.model.config.eos_token_id
+        if self.tokenizer.pad_token_id is None:
+            self.tokenizer.pad_token_id = self.tokenizer.eos_token_id
+        self.eos_token_id = self.tokenizer.eos_token_id
+
+    def load_model(self, model_class):
+        if self.quantize not in (None, 'int8', 'int4'):
+            raise ValueError(f"Unknown quantization: {self.quantize} (choose from int8, int4)")
+        if self.quantize is None:
+            return model_class.from_pretrained(self.model_name, trust_remote_code=True, torch_dtype=self.dtype).to(self.device)
+        if self.device.startswith('cuda'):
+            # bitsandbytes, as used for 8-bit fine-tuning
+            from transformers import BitsAndBytesConfig
+            config = BitsAndBytesConfig(load_in_8bit=True) if self.quantize == 'int8' else \
+                BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_compute_dtype=self.dtype)
+            return model_class.from_pretrained(self.model_name, trust_remote_code=True, quantization_config=config, device_map=self.device)
+        if self.quantize == 'int8':
+            # Dynamic quantization: int8 weights, activations quantized on the
+            # fly. It needs float32 weights to start from.
+            self.dtype = torch.float32
+            model = model_class.from_pretrained(self.model_name, trust_remote_code=True, torch_dtype=self.dtype, low_cpu_mem_usage=True)
+            with warnings.catch_warnings():
+                # torch.ao.quantization is deprecated in favour of torchao but
+                # still the only int8 path that needs no extra package
+                warnings.simplefilter('ignore')
+                model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+            return self.release_checkpoint(model)
+        # 4-bit weight-only
+        try:
+            from optimum.quanto import quantize, freeze, qint4
+        except ImportError:
+            raise RuntimeError("4-bit quantization on CPU requires optimum-quanto (pip install optimum-quanto)")
+        model = model_class.from_pretrained(self.model_name, trust_remote_code=True, torch_dtype=self.dtype, low_cpu_mem_usage=True)
+        quantize(model, weights=qint4)
+        freeze(model)
+        return self.release_checkpoint(model)
+
+    @staticmethod
+    def release_checkpoint(model):
+        # Parameters that were not quantized (embeddings, norms) still point
+        # into the memory-mapped checkpoint and keep all of it resident;
+        # copying them lets the mapping go
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            tensor.data = tensor.data.clone()
+        gc.collect()
+        return model
+
+    def model_nbytes(self):
+        # Weight memory, counting packed quantized weights at their real size
+        total = 0
+        for value in self.model.state_dict().values():
+            for tensor in (value if isinstance(value, tuple) else (value,)):
+                if torch.is_tensor(tensor):
+                    total += tensor.numel() * tensor.element_size()
+        return total
+
+    def encode_chat(self, messages):
+        if self.tokenizer.chat_template:
+            return self.tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_dict=False)
+        # Base models without a chat template just get the raw prompt
+        return self.tokenizer("\n".join(message['content'] for message in messages)).input_ids
+
+    def decode_tokens(self, token_ids):
+        return self.tokenizer.decode(token_ids, skip_special_tokens=True)
+
+    def forward(self, input_ids, past_key_values=None, attention_mask=None, position_ids=None):
+        with torch.no_grad():
+            outputs = self.model(
+                input_ids=input_ids,
+                past_key_values=from_legacy_cache(past_key_values),
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                use_cache=True,
+            )
+        return outputs.logits, to_legacy_cache(outputs.past_key_values)
+
+    def prefill(self, token_ids, state=None):
+        past_key_values = state.past_key_values if state else None
+        length = state.length if state else 0
+        input_ids = torch.tensor([token_ids], device=self.device)
+        logits, past_key_values = self.forward(input_ids, past_key_values)
+        return HFState(past_key_values, logits[:, -1, :], length + len(token_ids))
+
+    def sample(self, state):
+        return sample_token(state.logits, top_k=self.top_k, top_p=self.top_p)
+
+    def probs(self, logits):
+        return sampling_probs(logits, top_k=self.top_k, top_p=self.top_p)
+
+    def verify(self, state, token_ids):
+        # Feed several tokens in one forward pass and return the logits after
+        # each of them, for checking draft tokens during speculative decoding
+        input_ids = torch.tensor([token_ids], device=self.device)
+        logits, past_key_values = self.forward(input_ids, state.past_key_values)
+        return logits[0], HFState(past_key_values, logits[:, -1, :], state.length + len(token_ids))
+
+    def truncate(self, state, length):
+        # Drop cached positions past length, e.g. rejected draft tokens
+        past_key_values = tuple((key[:, :, :length], value[:, :, :length]) for key, value in state.past_key_values)
+        return HFState(past_key_values, None, length)
+
+    def state_nbytes(self, state):
+        size = state.logits.numel() * state.logits.element_size()
+        for key, value in state.past_key_values:
+            size += key.numel() * key.element_size() + value.numel() * value.element_size()
+        return size
+
+    def decode(self, state, token):
+        return self.prefill([token], state)
+
+    def decode_batch(self, states, tokens):
+        if len(states) == 1:
+            return [self.decode(states[0], tokens[0])]
+        self.batch_steps += 1
+        batch = states[0].batch
+        if batch is not None and batch.size == len(states) and all(state.batch is batch and state.row == i for i, state in enumerate(states)):
+            # The same sequences as the last step, in the same order: run on
+            # its padded cache, which every row has grown by one position
+            batch_past = batch.past_key_values
+            attention_mask = torch.cat([batch.attention_mask, batch.attention_mask.new_ones((len(states), 1))], dim=1)
+            max_length = attention_mask.shape[1] - 1
+        else:
+            # A sequence joined or left: left-pad every cache to the longest
+            # sequence and concatenate them, which copies the whole context
+            # of the batch, so it is only done when the batch changes
+            started = time.perf_counter()
+            self.batch_repads += 1
+            max_length = max(state.length for state in states)
+            batch_past = []
+            for layer in range(len(states[0].past_key_values)):
+                keys = []
+                values = []
+                for state in states:
+                    key, value = state.past_key_values[layer]
+                    pad = max_length - state.length
+                    if pad:
+                        key = torch.nn.functional.pad(key, (0, 0, pad, 0))
+                        value = torch.nn.functional.pad(value, (0, 0, pad, 0))
+                    keys.append(key)
+                    values.append(value)
+                batch_past.append((torch.cat(keys), torch.cat(values)))
+            batch_past = tuple(batch_past)
+            attention_mask = torch.zeros((len(states), max_length + 1), dtype=torch.long, device=self.device)
+            for i, state in enumerate(states):
+                attention_mask[i, max_length - state.length:] = 1
+            self.repad_seconds += time.perf_counter() - started
+        position_ids = torch.tensor([[state.length] for state in states], device=self.device)
+        input_ids = torch.tensor([[token] for token in tokens], device=self.device)
+        logits, past_key_values = self.forward(input_ids, batch_past, attention_mask, position_ids)
+        # Each state gets a view of its row without the padding, for callers
+        # that use it on its own
+        batch = HFBatch(past_key_values, attention_mask, len(states))
+        new_states = []
+        for i, state in enumerate(states):
+            start = max_length - state.length
+            past = tuple((key[i:i + 1, :, start:], value[i:i + 1, :, start:]) for key, value in past_key_values)
+            new_states.append(HFState(past, logits[i:i + 1, -1, :], state.length + 1, batch, i))
+        return new_states
+
+class TinyBackend(HFBackend):
+    # A small instruct model on CPU, for build and test boxes without a GPU
+    name = 'tiny'
+
+    def __init__(self, model=None, device=None, dtype=None, top_k=50, top_p=0.95, quantize=None):
+        super().__init__(model or DEFAULT_TINY_MODEL, device or 'cpu', dtype, top_k, top_p, quantize)
+
+CANNED_BODIES = {
+    'echo': "    print(' '.join(args.paths))",
+    'pwd': "    print(os.getcwd())",
+    'ls': """    for path in args.paths or ['.']:
+        try:
+            entries = sorted(os.listdir(path)) if os.path.isdir(path) else [path]
+        except OSError as e:
+            print(f"{PROG}: {e}", file=sys.stderr)
+            sys.exit(1)
+        for entry in entries:
+            print(entry)""",
+    'cat': """    for path in args.paths or ['-']:
+        try:
+            if path == '-':
+                shutil.copyfileobj(sys.stdin.buffer, sys.stdout.buffer)
+            else:
+                with open(path, 'rb') as f:
+                    shutil.copyfileobj(f, sys.stdout.buffer)
+        except OSError as e:
+            print(f"{PROG}: {e}", file=sys.stderr)
+            sys.exit(1)""",
+}
+
+DEFAULT_BODY = """    for line in sys.stdin if not sys.stdin.isatty() else []:
+        sys.stdout.write(line)"""
+
+def canned_option_names(args):
+    # Read the way argparse would, so -n5 asks for -n only; argparse
+    # declares -h and --help itself
+    return [option for option in requested_options(args) if option not in DEFAULT_OPTIONS]
+
+def canned_argument(option, parser='parser'):
+    if option.startswith('--'):
+        return f"{parser}.add_argument({option!r}, nargs='?', const=True)"
+    return f"{parser}.add_argument({option!r}, action='store_true')"
+
+def canned_script(command, options):
+    lines = [
+        "#!/usr/bin/env python3",
+        "import os",
+        "import sys",
+        "import shutil",
+        "import argparse",
+        "",
+        f"PROG = {command!r}",
+        "",
+        "def main():",
+        "    parser = argparse.ArgumentParser(prog=PROG)",
+        "    parser.add_argument('paths', nargs='*')",
+    ]
+    for option in sorted(set(options)):
+        lines.append("    " + canned_argument(option))
+    lines.append("    args = parser.parse_args()")
+    lines.append(CANNED_BODIES.get(command, DEFAULT_BODY))
+    lines += ["", "if __name__ == '__main__':", "    main()", ""]
+    return "\n".join(lines)
+
+class StubState:
+    def __init__(self, prompt_ids, response_ids=None, position=0):
+        self.prompt_ids = prompt_ids
+        self.response_ids = response_ids
+        self.position = position
+
+class StubBackend(ModelBackend):
+    # Deterministic backend that answers every prompt with a canned argparse
+    # script, so hamsh and the kernel can be exercised without any model.
+    name = 'stub'
+    model_id = 'stub'
+    eos_token_id = 0
+    token_pattern = re.compile(r'\s+|\w+|[^\w\s]')
+
+    def __init__(self, token_delay=0.0):
+        self.token_delay = token_delay
+        self.vocab = {'<eos>': 0}
+        self.tokens = ['<eos>']
+
+    def encode_text(self, text):
+        token_ids = []
+        for piece in self.token_pattern.findall(text):
+            if piece not in self.vocab:
+                self.vocab[piece] = len(self.tokens)
+                self.tokens.append(piece)
+            token_ids.append(self.vocab[piece])
+        return token_ids
+
+    def encode_chat(self, messages):
+        return self.encode_text("\n".join(message['content'] for message in messages))
+
+    def decode_tokens(self, token_ids):
+        return ''.join(self.tokens[token_id] for token_id in token_ids if token_id != self.eos_token_id)
+
+    def respond(self, prompt):
+        match = re.search(r"'([^']+)' (?:Unix )?command", prompt)
+        command = match.group(1) if match else 'command'
+        args = []
+        match = re.search(r"(?:Arguments|new arguments): (\[.*?\])", prompt)
+        if match:
+            try:
+                args = ast.literal_eval(match.group(1))
+            except (ValueError, SyntaxError):
+                args = []
+        options = canned_option_names(args)
+        match = re.search(r"The parser is `(\w+)`", prompt)
+        if match:
+            # Patch extension: only the arguments the script does not have yet
+            existing = set(re.findall(r"add_argument\('(-[^']+)'", prompt))
+            patch = "\n".join(canned_argument(option, match.group(1)) for option in sorted(set(options) - existing))
+            return f"```python\n{patch}\n```\n\nThese lines add the new options.\n"
+        # Keep whatever the existing script already declared when extending
+        options += re.findall(r"add_argument\('(-[^']+)'", prompt)
+        script = canned_script(command, options)
+        return f"```python\n{script}```\n\nThis script implements the '{command}' command using argparse.\n"
+
+    def prefill(self, token_ids, state=None):
+        # Simulated prefill cost: a fraction of a decode step per token
+        if self.token_delay:
+            time.sleep(self.token_delay * len(token_ids) / 32)
+        prompt_ids = (state.prompt_ids if state else []) + list(token_ids)
+        return StubState(prompt_ids)
+
+    def state_nbytes(self, state):
+        return 8 * len(state.prompt_ids)
+
+    def sample(self, state):
+        if state.response_ids is None:
+            state.response_ids = self.encode_text(self.respond(self.decode_tokens(state.prompt_ids))) + [self.eos_token_id]
+        return state.response_ids[min(state.position, len(state.response_ids) - 1)]
+
+    def decode(self, state, token):
+        return self.decode_batch([state], [token])[0]
+
+    def decode_batch(self, states, tokens):
+        # One simulated forward pass for the whole batch
+        if self.token_delay:
+            time.sleep(self.token_delay)
+        return [StubState(state.prompt_ids, state.response_ids, state.position + 1) for state in states]
+
+BACKENDS = {
+    'hf': HFBackend,
+    'tiny': TinyBackend,
+    'stub': StubBackend,
+}
+
+def create_backend(name, model=None, device=None, stub_delay=0.0, dtype=None, quantize=None):
+    logger.debug(f"Creating backend: {name}")
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend: {name} (choose from {', '.join(BACKENDS)})")
+    if name == 'stub':
+        return StubBackend(token_delay=stub_delay)
+    return BACKENDS[name](model=model, device=device, dtype=dtype, quantize=quantize)
@@ -0,0 +1,866 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import json
+import shlex
+import asyncio
+import logging
+import argparse
+import tempfile
+import subprocess
+from hamnix_logger import setup_logger
+from hamnix_prompts import get_command_prompt, get_extend_command_prompt, COMMAND_PROMPT_PREFIX, EXTEND_COMMAND_PROMPT_PREFIX
+from hamnix_prefix_cache import PrefixCache
+from hamnix_speculative import SpeculativeDecoder
+from hamnix_decode import decode_stream
+from hamnix_scheduler import BatchScheduler
+import hamnix_kernel
+import hamnix_lib
+import hamsh
+from hamnix_backends import create_backend, canned_script, torch
+from hamnix_lib import process_memory
+from hamnix_forkserver import ForkServerClient
+from hamnix_completion import Completer
+
+logger = setup_logger(__name__)
+
+def chunked_generate(backend, token_ids, max_new_tokens=512, chunk_size=20):
+    # The decode loop the kernel used before incremental decoding: every chunk
+    # re-prefills the prompt plus everything generated so far.
+    model, tokenizer = backend.model, backend.tokenizer
+    generated = list(token_ids)
+    with torch.no_grad():
+        for i in range(0, max_new_tokens, chunk_size):
+            outputs = model.generate(
+                torch.tensor([generated]).to(model.device),
+                max_new_tokens=chunk_size,
+                do_sample=True,
+                top_k=50,
+                top_p=0.95,
+                num_return_sequences=1,
+                pad_token_id=tokenizer.pad_token_id,
+                eos_token_id=tokenizer.eos_token_id,
+            )
+            new_tokens = outputs[0][len(generated):]
+            generated.extend(new_tokens.tolist())
+            if tokenizer.eos_token_id in new_tokens:
+                break
+    return generated[len(token_ids):]
+
+def incremental_generate(backend, token_ids, max_new_tokens=512):
+    return list(decode_stream(backend, token_ids, max_new_tokens=max_new_tokens))
+
+def bench_decode(args):
+    backend = create_backend(args.backend, args.model, args.device)
+    backend.load()
+    token_ids = backend.encode_chat([{'role': 'user', 'content': get_command_prompt('ls', ['-la'])}])
+    results = {}
+    for name, fn in (('chunked', chunked_generate), ('incremental', incremental_generate)):
+        total_tokens = 0
+        total_time = 0.0
+        for run in range(args.runs):
+            torch.manual_seed(run)
+            start = time.perf_counter()
+            tokens = fn(backend, token_ids, max_new_tokens=args.max_new_tokens)
+            if backend.device.startswith('cuda'):
+                torch.cuda.synchronize()
+            total_time += time.perf_counter() - start
+            total_tokens += len(tokens)
+        results[name] = total_tokens / total_time
+        print(f"{name:12s} {total_tokens:6d} tokens in {total_time:8.2f}s  {results[name]:8.2f} tokens/sec")
+    print(f"speedup      {results['incremental'] / results['chunked']:.2f}x")
+
+def bench_speculative(args):
+    target = create_backend(args.backend, args.model, args.device)
+    draft = create_backend(args.backend, args.draft_model, args.device)
+    target.load()
+    draft.load()
+    decoder = SpeculativeDecoder(target, draft, args.k)
+    decoder.check_compatible()
+    token_ids = target.encode_chat([{'role': 'user', 'content': get_command_prompt('ls', ['-la'])}])
+    results = {}
+    for name in ('target only', 'speculative'):
+        total_tokens = 0
+        total_time = 0.0
+        accepted = proposed = 0
+        for run in range(args.runs):
+            torch.manual_seed(run)
+            start = time.perf_counter()
+            if name == 'speculative':
+                tokens, stats = decoder.generate(token_ids, args.max_new_tokens)
+                accepted += stats['accepted']
+                proposed += stats['proposed']
+            else:
+                tokens = incremental_generate(target, token_ids, args.max_new_tokens)
+            total_time += time.perf_counter() - start
+            total_tokens += len(tokens)
+        results[name] = total_tokens / total_time
+        acceptance = f"  acceptance rate {accepted / proposed:.2%}" if proposed else ''
+        print(f"{name:12s} {total_tokens:6d} tokens in {total_time:8.2f}s  {results[name]:8.2f} tokens/sec{acceptance}")
+    print(f"speedup      {results['speculative'] / results['target only']:.2f}x")
+
+BENCH_COMMANDS = ['ls', 'cat', 'echo', 'pwd', 'grep', 'wc', 'sort', 'head', 'tail', 'cut', 'uniq', 'tr', 'find', 'du', 'df', 'tee']
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(pct / 100 * len(values))) - 1))
+    return values[index]
+
+async def run_clients(backend, clients, max_batch_size, max_new_tokens):
+    scheduler = BatchScheduler(backend, max_batch_size)
+    prompts = [backend.encode_chat([{'role': 'user', 'content': get_command_prompt(BENCH_COMMANDS[i % len(BENCH_COMMANDS)], ['-v'])}])
+               for i in range(clients)]
+    latencies = []
+
+    async def client(token_ids):
+        start = time.perf_counter()
+        tokens = await scheduler.generate(token_ids, max_new_tokens)
+        latencies.append(time.perf_counter() - start)
+        return len(tokens)
+
+    start = time.perf_counter()
+    counts = await asyncio.gather(*(client(token_ids) for token_ids in prompts))
+    elapsed = time.perf_counter() - start
+    scheduler.close()
+    return sum(counts), elapsed, latencies
+
+def bench_batch(args):
+    backend = create_backend(args.backend, args.model, args.device, args.stub_delay)
+    backend.load()
+    # HF backends count the batch steps that had to pad and concatenate the
+    # KV caches again, which happens only when sequences join or leave
+    repads = hasattr(backend, 'batch_repads')
+    print(f"{'mode':10s} {'clients':>7s} {'tokens':>7s} {'tokens/sec':>11s} {'p50 latency':>12s} {'max latency':>12s}"
+          + (f" {'steps':>6s} {'re-pads':>7s} {'re-pad time':>11s}" if repads else ''))
+    for clients in args.clients:
+        for mode, max_batch_size in (('serial', 1), ('batched', args.max_batch_size)):
+            if repads:
+                backend.batch_steps = backend.batch_repads = 0
+                backend.repad_seconds = 0.0
+            tokens, elapsed, latencies = asyncio.run(run_clients(backend, clients, max_batch_size, args.max_new_tokens))
+            print(f"{mode:10s} {clients:7d} {tokens:7d} {tokens / elapsed:11.2f} {percentile(latencies, 50):11.3f}s {max(latencies):11.3f}s"
+                  + (f" {backend.batch_steps:6d} {backend.batch_repads:7d} {backend.repad_seconds:10.3f}s" if repads else ''))
+
+async def measure_ttft(backend, prompts, prefix, use_cache):
+    # Generating a single token makes the request latency its time to first token
+    prefix_cache = PrefixCache(backend, 1024 * 1024 * 1024) if use_cache else None
+    scheduler = BatchScheduler(backend, 1, prefix_cache)
+    latencies = []
+    for token_ids in prompts:
+        start = time.perf_counter()
+        await scheduler.generate(token_ids, 1, prefix=prefix)
+        latencies.append(time.perf_counter() - start)
+    scheduler.close()
+    return latencies, prefix_cache.stats() if prefix_cache else None
+
+def bench_prefix(args):
+    backend = create_backend(args.backend, args.model, args.device, args.stub_delay)
+    backend.load()
+    commands = [BENCH_COMMANDS[i % len(BENCH_COMMANDS)] for i in range(args.requests)]
+    task_types = {
+        'generate_command': ([get_command_prompt(command, ['-v']) for command in commands], COMMAND_PROMPT_PREFIX),
+        'extend_command': ([get_extend_command_prompt(command, ['-n'], canned_script(command, ['-v'])) for command in commands],
+                           EXTEND_COMMAND_PROMPT_PREFIX),
+    }
+    print(f"{'task type':18s} {'prefix cache':>12s} {'mean ttft':>10s} {'p95 ttft':>10s} {'hits':>5s} {'misses':>6s}")
+    for task_type, (prompts, prefix) in task_types.items():
+        prompts = [backend.encode_chat([{'role': 'user', 'content': prompt}]) for prompt in prompts]
+        for use_cache in (False, True):
+            latencies, stats = asyncio.run(measure_ttft(backend, prompts, prefix, use_cache))
+            print(f"{task_type:18s} {'on' if use_cache else 'off':>12s} {sum(latencies) / len(latencies) * 1000:8.1f}ms "
+                  f"{percentile(latencies, 95) * 1000:8.1f}ms {stats['hits'] if stats else '-':>5} {stats['misses'] if stats else '-':>6}")
+
+async def kernel_request(socket_path, message):
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    writer.write(json.dumps(message).encode() + b'\n')
+    await writer.drain()
+    response = json.loads(await reader.readuntil(b'\n'))
+    writer.close()
+    await writer.wait_closed()
+    return response
+
+async def measure_cached(args, socket_path):
+    server = await asyncio.start_unix_server(hamnix_kernel.handle_client, socket_path)
+    await hamnix_kernel.kernel.load_backend()
+    cached = {'type': 'generate_command', 'command': 'cached', 'args': [], 'context_id': 'bench'}
+    await kernel_request(socket_path, cached)
+    generating = asyncio.create_task(kernel_request(socket_path, {
+        'type': 'generate_command', 'command': 'slow', 'args': [], 'context_id': 'bench', 'force_regenerate': True}))
+    await asyncio.sleep(0.05)
+    latencies = []
+    for _ in range(args.requests):
+        if generating.done():
+            break
+        start = time.perf_counter()
+        await kernel_request(socket_path, cached)
+        latencies.append(time.perf_counter() - start)
+    await generating
+    # Give the connection handlers a moment to see the clients hang up
+    await asyncio.sleep(0.1)
+    server.close()
+    await server.wait_closed()
+    hamnix_kernel.kernel.scheduler.close()
+    return latencies
+
+def bench_cached(args):
+    workdir = tempfile.mkdtemp(prefix='hamnix-bench-')
+    os.chdir(workdir)
+    hamnix_kernel.kernel = hamnix_kernel.HamnixKernel(create_backend('stub', stub_delay=args.stub_delay))
+    latencies = asyncio.run(measure_cached(args, os.path.join(workdir, 'kernel.sock')))
+    print(f"{len(latencies)} cache-hit requests while another session was generating")
+    for pct in (50, 95, 99):
+        print(f"p{pct}: {percentile(latencies, pct) * 1000:.3f} ms")
+
+async def wait_for_kernel(socket_path, message, done, process=None, poll=0.01):
+    while True:
+        if process is not None and process.returncode is not None:
+            raise RuntimeError(f"Kernel exited with status {process.returncode}")
+        try:
+            response = await kernel_request(socket_path, message)
+            if done(response):
+                return response
+        except (ConnectionRefusedError, FileNotFoundError):
+            pass
+        await asyncio.sleep(poll)
+
+async def measure_startup(args, workdir):
+    socket_path = os.path.join(workdir, 'kernel.sock')
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hamnix_kernel.py'),
+           '--backend', args.backend, '--socket', socket_path]
+    if args.model:
+        cmd += ['--model', args.model]
+    start = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(*cmd, cwd=workdir, stderr=asyncio.subprocess.DEVNULL)
+    try:
+        await wait_for_kernel(socket_path, {'type': 'health'}, lambda response: 'result' in response, process)
+        socket_ready = time.perf_counter() - start
+        await wait_for_kernel(socket_path, {'type': 'generate_command', 'command': 'cached', 'args': [], 'context_id': 'bench'},
+                              lambda response: 'result' in response, process)
+        cached_ready = time.perf_counter() - start
+        health = await wait_for_kernel(socket_path, {'type': 'health'},
+                                       lambda response: response['result']['ready'] or response['result']['error'], process)
+        model_ready = time.perf_counter() - start
+    finally:
+        if process.returncode is None:
+            process.terminate()
+        await process.wait()
+    return socket_ready, cached_ready, model_ready, health['result']
+
+def bench_startup(args):
+    workdir = tempfile.mkdtemp(prefix='hamnix-bench-')
+    # Pre-populate the cache so the cached lookup can be served before the model is up
+    os.makedirs(os.path.join(workdir, 'abin'))
+    with open(os.path.join(workdir, 'abin', 'cached'), 'w') as f:
+        f.write("#!/usr/bin/env python3\n")
+    socket_ready, cached_ready, model_ready, health = asyncio.run(measure_startup(args, workdir))
+    print(f"socket accepting requests: {socket_ready:.3f}s")
+    print(f"first cached script served: {cached_ready:.3f}s")
+    print(f"model ready: {model_ready:.3f}s (backend load {health['load_time'] or 0:.3f}s)")
+    if health['error']:
+        print(f"backend failed to load: {health['error']}")
+
+async def time_spawns(spawn, path, args, runs):
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        process = await spawn(path, *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        await asyncio.gather(process.stdout.read(), process.stderr.read())
+        if await process.wait() != 0:
+            raise RuntimeError(f"{path} exited with status {process.returncode}")
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+async def measure_spawn(args, path):
+    forkserver = ForkServerClient()
+    await forkserver.start()
+    try:
+        # One untimed run each warms the page cache and the fork server's code cache
+        await time_spawns(asyncio.create_subprocess_exec, path, args.args, 1)
+        await time_spawns(forkserver.create_subprocess_exec, path, args.args, 1)
+        return {
+            'exec': await time_spawns(asyncio.create_subprocess_exec, path, args.args, args.runs),
+            'forkserver': await time_spawns(forkserver.create_subprocess_exec, path, args.args, args.runs),
+        }
+    finally:
+        await forkserver.close()
+
+def bench_spawn(args):
+    workdir = tempfile.mkdtemp(prefix='hamnix-bench-')
+    path = os.path.join(workdir, args.command)
+    with open(path, 'w') as f:
+        f.write(canned_script(args.command, [arg for arg in args.args if arg.startswith('-')]))
+    os.chmod(path, 0o755)
+    results = asyncio.run(measure_spawn(args, path))
+    for name, latencies in results.items():
+        print(f"{name:10s} mean {sum(latencies) / len(latencies) * 1000:7.2f} ms  p50 {percentile(latencies, 50) * 1000:7.2f} ms"
+              f"  p95 {percentile(latencies, 95) * 1000:7.2f} ms")
+    print(f"speedup    {sum(results['exec']) / sum(results['forkserver']):.2f}x")
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPLAY_COMMANDS = os.path.join(REPO_DIR, 'old_bin', 'chroot_bin', 'bash_cmds.txt')
+REPLAY_TERMINAL_LOG = os.path.join(REPO_DIR, 'old_bin', 'old', 'done', 'terminal_log.jsonl')
+
+def terminal_log_lines(path):
+    # The log has one "input" event per keystroke; a newline ends the line
+    lines = []
+    line = ''
+    with open(path) as f:
+        for entry in f:
+            try:
+                event = json.loads(entry)
+            except json.JSONDecodeError:
+                continue
+            if event.get('type') != 'input':
+                continue
+            for char in event['content']:
+                if char in '\r\n':
+                    if line.strip():
+                        lines.append(line.strip())
+                    line = ''
+                elif char in '\x7f\b':
+                    line = line[:-1]
+                else:
+                    line += char
+    return lines
+
+def replay_lines(args):
+    # (line, parsed pipeline) for every line hamsh can parse
+    lines = []
+    if args.source in ('commands', 'both'):
+        with open(args.commands) as f:
+            lines += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    if args.source in ('terminal', 'both'):
+        lines += terminal_log_lines(args.terminal_log)
+    parsed = []
+    for line in lines:
+        try:
+            commands = hamsh.parse_command(line)
+        except ValueError:
+            continue
+        if line != 'exit' and all(commands):
+            parsed.append((line, commands))
+    if args.limit:
+        parsed = parsed[:args.limit]
+    return parsed, len(lines)
+
+async def start_kernel(args, workdir):
+    socket_path = os.path.join(workdir, 'kernel.sock')
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hamnix_kernel.py'),
+           '--backend', args.backend, '--socket', socket_path, '--stub-delay', str(args.stub_delay)]
+    if args.model:
+        cmd += ['--model', args.model]
+    cmd += shlex.split(args.kernel_args)
+    process = await asyncio.create_subprocess_exec(*cmd, cwd=workdir, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+    # Timing starts once the model is loaded
+    health = await wait_for_kernel(socket_path, {'type': 'health'},
+                                   lambda response: 'result' in response and (response['result']['ready'] or response['result']['error']), process)
+    if health['result']['error']:
+        process.terminate()
+        await process.wait()
+        raise RuntimeError(f"Kernel backend failed to load: {health['result']['error']}")
+    hamnix_lib.KERNEL_SOCKET = socket_path
+    return process, socket_path
+
+async def stop_kernel(process):
+    if process.returncode is None:
+        process.terminate()
+    await process.wait()
+
+def counter_delta(before, after, name):
+    before = before['counters'].get(name, {})
+    return {series: value - before.get(series, 0) for series, value in after['counters'].get(name, {}).items()
+            if value != before.get(series, 0)}
+
+async def replay_phase(socket_path, sessions, timeout):
+    # Replays each session's lines in order, the sessions concurrently.
+    # Latency is per command line, from hamsh asking the kernel for the
+    # script to the last stage exiting.
+    before = (await kernel_request(socket_path, {'type': 'stats'}))['result']
+    latencies = []
+    failures = 0
+    timeouts = 0
+
+    async def session(lines):
+        nonlocal failures, timeouts
+        for line, commands in lines:
+            start = time.perf_counter()
+            try:
+                status = await asyncio.wait_for(hamsh.run_pipeline(commands), timeout)
+            except asyncio.TimeoutError:
+                timeouts += 1
+                status = None
+            except Exception:
+                status = None
+            latencies.append(time.perf_counter() - start)
+            if status != 0:
+                failures += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(session(lines) for lines in sessions))
+    elapsed = time.perf_counter() - start
+    after = (await kernel_request(socket_path, {'type': 'stats'}))['result']
+    script_cache = counter_delta(before, after, 'script_cache')
+    extends = counter_delta(before, after, 'extends')
+    return {
+        "sessions": len(sessions),
+        "lines": len(latencies),
+        "seconds": elapsed,
+        "lines_per_second": len(latencies) / elapsed if elapsed else None,
+        "latency": {
+            "mean": sum(latencies) / len(latencies) if latencies else None,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies, default=None),
+        },
+        "generations": script_cache.get('result=miss', 0),
+        "extensions": sum(extends.values()),
+        # Found by hamsh's option check before the line ran, and after a
+        # script had already run and exited with status 2
+        "pre_run_extensions": extends.get('reason=validation', 0),
+        "exit_2_extensions": extends.get('reason=exit_status_2', 0),
+        "cache_hits": script_cache.get('result=hit', 0),
+        "dedup_hits": after['dedup_hits'] - before['dedup_hits'],
+        "failures": failures,
+        "timeouts": timeouts,
+        "kernel_errors": counter_delta(before, after, 'errors'),
+    }
+
+# Each command first without options, so its script declares none, then
+# with some; hamsh should extend the script before running the second line
+OPTION_LINES = ["ls", "ls -la", "cat /dev/null", "cat -n /dev/null", "ls -la -r"]
+
+async def measure_replay(args, lines, workdir):
+    results = {}
+    await hamsh.start_forkserver()
+    try:
+        # Cold: empty script store. Warm: the same kernel and store again.
+        process, socket_path = await start_kernel(args, workdir)
+        try:
+            results['cold'] = await replay_phase(socket_path, [lines], args.timeout)
+            results['warm'] = await replay_phase(socket_path, [lines], args.timeout)
+        finally:
+            await stop_kernel(process)
+        # Concurrent: a fresh kernel and store, each session starting at a
+        # different point of the stream so they mostly ask for different
+        # commands at first and the same ones later on
+        concurrent_dir = os.path.join(workdir, 'concurrent')
+        os.makedirs(concurrent_dir)
+        process, socket_path = await start_kernel(args, concurrent_dir)
+        try:
+            step = len(lines) // args.sessions
+            sessions = [lines[i * step:] + lines[:i * step] for i in range(args.sessions)]
+            results['concurrent'] = await replay_phase(socket_path, sessions, args.timeout)
+        finally:
+            await stop_kernel(process)
+        # Options: lines that add options to commands the store already has
+        options_dir = os.path.join(workdir, 'options')
+        os.makedirs(options_dir)
+        process, socket_path = await start_kernel(args, options_dir)
+        try:
+            results['options'] = await replay_phase(socket_path, [[(line, hamsh.parse_command(line)) for line in OPTION_LINES]],
+                                                    args.timeout)
+        finally:
+            await stop_kernel(process)
+    finally:
+        if hamsh.forkserver is not None:
+            await hamsh.forkserver.close()
+    return results
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def bench_replay(args):
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+    lines, recorded = replay_lines(args)
+    if not lines:
+        sys.exit("No replayable command lines")
+    workdir = tempfile.mkdtemp(prefix='hamnix-bench-')
+    # The replayed commands really run: in a scratch home directory, with
+    # no terminal on stdin and their output discarded
+    home = os.path.join(workdir, 'home')
+    os.makedirs(home)
+    os.environ['HOME'] = home
+    os.chdir(home)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    # stderr at the descriptor level, for the fork server's logging too
+    stderr_fd = os.dup(2)
+    if not args.verbose:
+        os.dup2(devnull, 2)
+    os.close(devnull)
+    try:
+        results = asyncio.run(measure_replay(args, lines, workdir))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        os.dup2(stderr_fd, 2)
+        os.close(stderr_fd)
+        logging.disable(logging.NOTSET)
+    report = {
+        "revision": git_revision(),
+        "backend": args.backend,
+        "model": args.model,
+        "stub_delay": args.stub_delay,
+        "kernel_args": args.kernel_args,
+        "source": args.source,
+        "recorded_lines": recorded,
+        "replayed_lines": len(lines),
+        "phases": results,
+    }
+    print(f"{len(lines)} of {recorded} recorded lines replayed, scratch directory {workdir}")
+    print(f"{'phase':11s} {'lines':>6s} {'lines/s':>8s} {'p50':>9s} {'p95':>9s} {'p99':>9s} {'gens':>5s} {'pre-run':>7s} {'exit-2':>6s} {'failed':>6s} {'timeouts':>8s}")
+    for phase, result in results.items():
+        latency = result['latency']
+        print(f"{phase:11s} {result['lines']:6d} {result['lines_per_second']:8.2f} {latency['p50'] * 1000:7.1f}ms {latency['p95'] * 1000:7.1f}ms "
+              f"{latency['p99'] * 1000:7.1f}ms {result['generations']:5d} {result['pre_run_extensions']:7d} {result['exit_2_extensions']:6d} {result['failures']:6d} {result['timeouts']:8d}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+# Scripts for the pipeline benchmark, installed into the store directly
+PIPELINE_SCRIPTS = {
+    'produce': '''#!/usr/bin/env python3
+import os
+import argparse
+
+parser = argparse.ArgumentParser(prog='produce')
+parser.add_argument('--bytes', type=int, required=True)
+args = parser.parse_args()
+chunk = memoryview(b'x' * (1 << 20))
+remaining = args.bytes
+while remaining > 0:
+    remaining -= os.write(1, chunk[:min(remaining, len(chunk))])
+''',
+    'count': '''#!/usr/bin/env python3
+import os
+import argparse
+
+parser = argparse.ArgumentParser(prog='count')
+args = parser.parse_args()
+total = 0
+while True:
+    data = os.read(0, 1 << 20)
+    if not data:
+        break
+    total += len(data)
+print(total)
+''',
+    'cat': canned_script('cat', []),
+}
+
+PIPELINES = [
+    "produce --bytes {bytes} | count > {result}",
+    "produce --bytes {bytes} | cat | count > {result}",
+    "produce --bytes {bytes} | cat | cat | cat | count > {result}",
+]
+
+class Discard:
+    # A stdout with no descriptor behind it, which hamsh has to relay into
+    def __init__(self):
+        self.buffer = self
+
+    def write(self, data):
+        return len(data)
+
+    def flush(self):
+        pass
+
+async def time_pipeline(run, line, result_path, nbytes):
+    start = time.perf_counter()
+    status = await run(line)
+    elapsed = time.perf_counter() - start
+    if result_path is None:
+        if status != 0:
+            raise RuntimeError(f"'{line}' exited with status {status}")
+        return elapsed
+    with open(result_path) as f:
+        counted = f.read().strip()
+    if status != 0 or counted != str(nbytes):
+        raise RuntimeError(f"'{line}' exited with status {status} after passing {counted or 'no'} bytes")
+    return elapsed
+
+async def measure_pipelines(args, workdir, nbytes, output_bytes):
+    abin = os.path.join(workdir, 'abin')
+    result_path = os.path.join(workdir, 'result')
+    devnull = open(os.devnull, 'w')
+
+    async def run_hamsh(line):
+        return await hamsh.run_pipeline(hamsh.parse_command(line))
+
+    async def run_sh(line):
+        # The same scripts run by /bin/sh, as the baseline
+        for command in PIPELINE_SCRIPTS:
+            line = line.replace(f"{command} ", f"{os.path.join(abin, command)} ")
+        process = await asyncio.create_subprocess_shell(line, stdout=devnull)
+        return await process.wait()
+
+    async def time_runs(run, line, result_path, nbytes):
+        return min([await time_pipeline(run, line, result_path, nbytes) for _ in range(args.runs)])
+
+    await hamsh.start_forkserver()
+    process, socket_path = await start_kernel(args, workdir)
+    results = []
+    try:
+        for pipeline in PIPELINES:
+            # Small untimed run so every script is resolved and cached
+            await time_pipeline(run_hamsh, pipeline.format(bytes=1 << 20, result=result_path), result_path, 1 << 20)
+            line = pipeline.format(bytes=nbytes, result=result_path)
+            timings = {}
+            for name, run in (('hamsh', run_hamsh), ('sh', run_sh)):
+                timings[name] = await time_runs(run, line, result_path, nbytes)
+            results.append((pipeline.format(bytes='N', result='result'), nbytes, timings))
+        # A command writing straight to hamsh's stdout, which the child gets
+        # as its own descriptor, and to a stdout hamsh has to relay into
+        line = f"produce --bytes {output_bytes}"
+        stdout = sys.stdout
+        try:
+            sys.stdout = devnull
+            timings = {'hamsh': await time_runs(run_hamsh, line, None, output_bytes),
+                       'sh': await time_runs(run_sh, line, None, output_bytes)}
+            results.append(("produce --bytes N (to stdout)", output_bytes, timings))
+            sys.stdout = Discard()
+            timings = {'hamsh': await time_runs(run_hamsh, line, None, output_bytes)}
+            results.append(("produce --bytes N (relayed by hamsh)", output_bytes, timings))
+        finally:
+            sys.stdout = stdout
+    finally:
+        devnull.close()
+        await stop_kernel(process)
+        if hamsh.forkserver is not None:
+            await hamsh.forkserver.close()
+    return results
+
+def bench_pipeline(args):
+    workdir = tempfile.mkdtemp(prefix='hamnix-bench-')
+    os.makedirs(os.path.join(workdir, 'abin'))
+    for command, code in PIPELINE_SCRIPTS.items():
+        path = os.path.join(workdir, 'abin', command)
+        with open(path, 'w') as f:
+            f.write(code)
+        os.chmod(path, 0o755)
+    os.chdir(workdir)
+    logging.disable(logging.CRITICAL)
+    results = asyncio.run(measure_pipelines(args, workdir, int(args.gb * (1 << 30)), int(args.output_gb * (1 << 30))))
+    print(f"{args.gb:g} GiB through each pipeline, {args.output_gb:g} GiB of output, best of {args.runs}")
+    print(f"{'pipeline':55s} {'hamsh':>10s} {'sh':>10s}")
+
+    def throughput(nbytes, seconds):
+        return f"{nbytes / seconds / (1 << 30):6.2f}GB/s" if seconds else f"{'-':>10s}"
+
+    for pipeline, nbytes, timings in results:
+        print(f"{pipeline:55s} {throughput(nbytes, timings.get('hamsh'))} {throughput(nbytes, timings.get('sh'))}")
+
+COMPLETION_OPTIONS = ['--all', '--color', '--long', '--lines', '--recursive', '--verbose', '-n', '-r']
+
+def time_completion(completer, line, text, runs):
+    # One keypress: every state readline asks for, until None
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        state = 0
+        while completer.complete(line, text, state) is not None:
+            state += 1
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def bench_completion(args):
+    workdir = tempfile.mkdtemp(prefix='hamnix-bench-')
+    abin = os.path.join(workdir, 'abin')
+    os.makedirs(abin)
+    for i in range(args.commands):
+        with open(os.path.join(abin, f"cmd{i}"), 'w') as f:
+            f.write(canned_script(f"cmd{i}", COMPLETION_OPTIONS))
+    os.makedirs(os.path.join(workdir, 'files'))
+    for i in range(args.files):
+        open(os.path.join(workdir, 'files', f"file{i}.txt"), 'w').close()
+    os.chdir(workdir)
+    logging.disable(logging.CRITICAL)
+    completer = Completer(abin)
+    cases = [
+        ("command", '', 'cmd12'),
+        ("option", 'cmd12 ', '--l'),
+        ("path", 'cmd12 ', 'files/file12'),
+    ]
+    print(f"{args.commands} commands, {args.files} files, {args.runs} runs")
+    for name, line, text in cases:
+        cold = time_completion(completer, line, text, 1)[0]
+        warm = time_completion(completer, line, text, args.runs)
+        print(f"{name:10s} first {cold * 1000:7.3f} ms  p50 {percentile(warm, 50) * 1000:7.3f} ms"
+              f"  p99 {percentile(warm, 99) * 1000:7.3f} ms  matches {len(completer.matches)}")
+    # A newly published command shows up on the next keypress
+    with open(os.path.join(abin, 'cmd12new'), 'w') as f:
+        f.write(canned_script('cmd12new', COMPLETION_OPTIONS))
+    reindex = time_completion(completer, '', 'cmd12', 1)[0]
+    print(f"{'reindex':10s} first {reindex * 1000:7.3f} ms  matches {len(completer.matches)}")
+
+# mode -> (dtype, quantize)
+QUANTIZE_MODES = {
+    'fp32': ('float32', None),
+    'bf16': ('bfloat16', None),
+    'int8': (None, 'int8'),
+    'int4': ('bfloat16', 'int4'),
+}
+
+def measure_quantized(args):
+    # Runs in a fresh process per mode so resident memory is not shared
+    dtype, quantize = QUANTIZE_MODES[args.child]
+    torch.manual_seed(0)
+    start = time.perf_counter()
+    backend = create_backend(args.backend, args.model, args.device, dtype=dtype, quantize=quantize)
+    backend.load()
+    load_time = time.perf_counter() - start
+    memory = process_memory()
+    token_ids = backend.encode_chat([{'role': 'user', 'content': get_command_prompt('ls', ['-la'])}])
+    total_tokens = 0
+    total_time = 0.0
+    for run in range(args.runs):
+        torch.manual_seed(run)
+        start = time.perf_counter()
+        total_tokens += len(incremental_generate(backend, token_ids, args.max_new_tokens))
+        total_time += time.perf_counter() - start
+    print(json.dumps({
+        "load_time": load_time,
+        "model_bytes": backend.model_nbytes(),
+        "rss_bytes": memory['rss_bytes'],
+        "peak_rss_bytes": process_memory()['peak_rss_bytes'],
+        "tokens_per_sec": total_tokens / total_time,
+    }))
+
+def bench_quantize(args):
+    if args.child:
+        return measure_quantized(args)
+    results = {}
+    for mode in args.modes:
+        cmd = [sys.executable, os.path.abspath(__file__), 'quantize', '--child', mode, '--backend', args.backend,
+               '--max-new-tokens', str(args.max_new_tokens), '--runs', str(args.runs)]
+        if args.model:
+            cmd += ['--model', args.model]
+        if args.device:
+            cmd += ['--device', args.device]
+        process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if process.returncode != 0:
+            error = process.stderr.strip().splitlines()
+            print(f"{mode:5s} failed: {error[-1] if error else process.returncode}")
+            continue
+        result = results[mode] = json.loads(process.stdout.strip().splitlines()[-1])
+        baseline = results.get(args.modes[0])
+        relative = (f"  {result['rss_bytes'] / baseline['rss_bytes']:5.2f}x rss"
+                    f"  {result['tokens_per_sec'] / baseline['tokens_per_sec']:5.2f}x speed") if baseline and mode != args.modes[0] else ''
+        print(f"{mode:5s} load {result['load_time']:7.2f}s  weights {result['model_bytes'] / 2**20:8.1f} MB"
+              f"  rss {result['rss_bytes'] / 2**20:8.1f} MB  peak {result['peak_rss_bytes'] / 2**20:8.1f} MB"
+              f"  {result['tokens_per_sec']:8.2f} tokens/sec{relative}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Hamnix kernel benchmarks")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    decode_parser = subparsers.add_parser('decode', help="Compare incremental KV-cache decoding with the old chunked generate loop")
+    decode_parser.add_argument('--backend', choices=['hf', 'tiny'], default='hf')
+    decode_parser.add_argument('--model', help="Model name or path (default: the backend's model)")
+    decode_parser.add_argument('--device', help="Torch device (default: the backend's device)")
+    decode_parser.add_argument('--max-new-tokens', type=int, default=512)
+    decode_parser.add_argument('--runs', type=int, default=3)
+    decode_parser.set_defaults(func=bench_decode)
+
+    speculative_parser = subparsers.add_parser('speculative', help="Compare speculative decoding with a draft model against the target model alone")
+    speculative_parser.add_argument('--backend', choices=['hf', 'tiny'], default='tiny')
+    speculative_parser.add_argument('--model', default="Qwen/Qwen2-1.5B-Instruct", help="Target model")
+    speculative_parser.add_argument('--draft-model', default="Qwen/Qwen2-0.5B-Instruct", help="Draft model sharing the target's tokenizer")
+    speculative_parser.add_argument('--device', help="Torch device (default: the backend's device)")
+    speculative_parser.add_argument('--k', type=int, default=4, help="Draft tokens per step")
+    speculative_parser.add_argument('--max-new-tokens', type=int, default=256)
+    speculative_parser.add_argument('--runs', type=int, default=3)
+    speculative_parser.set_defaults(func=bench_speculative)
+
+    batch_parser = subparsers.add_parser('batch', help="Aggregate throughput and latency of the continuous batching scheduler")
+    batch_parser.add_argument('--backend', choices=['hf', 'tiny', 'stub'], default='stub')
+    batch_parser.add_argument('--model', help="Model name or path (default: the backend's model)")
+    batch_parser.add_argument('--device', help="Torch device (default: the backend's device)")
+    batch_parser.add_argument('--stub-delay', type=float, default=0.01, help="Seconds per decode step for the stub backend")
+    batch_parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16])
+    batch_parser.add_argument('--max-batch-size', type=int, default=16)
+    batch_parser.add_argument('--max-new-tokens', type=int, default=512)
+    batch_parser.set_defaults(func=bench_batch)
+
+    prefix_parser = subparsers.add_parser('prefix', help="Time to first token with and without the prompt prefix cache")
+    prefix_parser.add_argument('--backend', choices=['hf', 'tiny', 'stub'], default='stub')
+    prefix_parser.add_argument('--model', help="Model name or path (default: the backend's model)")
+    prefix_parser.add_argument('--device', help="Torch device (default: the backend's device)")
+    prefix_parser.add_argument('--stub-delay', type=float, default=0.01, help="Seconds per decode step for the stub backend")
+    prefix_parser.add_argument('--requests', type=int, default=16)
+    prefix_parser.set_defaults(func=bench_prefix)
+
+    cached_parser = subparsers.add_parser('cached', help="Cache-hit round-trip latency while another session is generating")
+    cached_parser.add_argument('--stub-delay', type=float, default=0.01, help="Seconds per decode step for the stub backend")
+    cached_parser.add_argument('--requests', type=int, default=200)
+    cached_parser.set_defaults(func=bench_cached)
+
+    startup_parser = subparsers.add_parser('startup', help="Time until the kernel socket, cached lookups and the model are ready")
+    startup_parser.add_argument('--backend', choices=['hf', 'tiny', 'stub'], default='stub')
+    startup_parser.add_argument('--model', help="Model name or path (default: the backend's model)")
+    startup_parser.set_defaults(func=bench_startup)
+
+    quantize_parser = subparsers.add_parser('quantize', help="Resident memory, load time and decode speed of quantized models against bf16")
+    quantize_parser.add_argument('--backend', choices=['hf', 'tiny'], default='tiny')
+    quantize_parser.add_argument('--model', help="Model name or path (default: the backend's model)")
+    quantize_parser.add_argument('--device', help="Torch device (default: the backend's device)")
+    quantize_parser.add_argument('--modes', nargs='+', choices=list(QUANTIZE_MODES), default=['bf16', 'int8', 'int4'],
+                                 help="Modes to compare; the first one is the baseline")
+    quantize_parser.add_argument('--max-new-tokens', type=int, default=128)
+    quantize_parser.add_argument('--runs', type=int, default=3)
+    quantize_parser.add_argument('--child', choices=list(QUANTIZE_MODES), help=argparse.SUPPRESS)
+    quantize_parser.set_defaults(func=bench_quantize)
+
+    spawn_parser = subparsers.add_parser('spawn', help="Per-command start-up cost of a new python3 process against the hamsh fork server")
+    spawn_parser.add_argument('--command', default='echo', help="Canned stub script to run")
+    spawn_parser.add_argument('args', nargs='*', default=['hello'], help="Arguments for the script, after -- if they start with a dash")
+    spawn_parser.add_argument('--runs', type=int, default=100)
+    spawn_parser.set_defaults(func=bench_spawn)
+
+    replay_parser = subparsers.add_parser('replay', help="Replay recorded command lines through a kernel and hamsh: cold cache, warm cache and concurrent sessions")
+    replay_parser.add_argument('--backend', choices=['hf', 'tiny', 'stub'], default='stub',
+                               help="Kernel backend; the generated scripts are executed, so only use a model backend on a throwaway machine")
+    replay_parser.add_argument('--model', help="Model name or path (default: the backend's model)")
+    replay_parser.add_argument('--stub-delay', type=float, default=0.0, help="Seconds per decode step for the stub backend")
+    replay_parser.add_argument('--kernel-args', default='', help="Extra kernel options, e.g. '--candidates 2'")
+    replay_parser.add_argument('--source', choices=['commands', 'terminal', 'both'], default='both',
+                               help="Replay bash_cmds.txt, the recorded terminal sessions, or both")
+    replay_parser.add_argument('--commands', default=REPLAY_COMMANDS, help="One command line per line")
+    replay_parser.add_argument('--terminal-log', default=REPLAY_TERMINAL_LOG, help="Recorded terminal session, one JSON event per line")
+    replay_parser.add_argument('--limit', type=int, help="Replay only the first N lines")
+    replay_parser.add_argument('--sessions', type=int, default=4, help="Concurrent sessions in the concurrent phase")
+    replay_parser.add_argument('--timeout', type=float, default=10, help="Seconds before a command line counts as timed out")
+    replay_parser.add_argument('--output', help="Write the results as JSON to this file")
+    replay_parser.add_argument('--verbose', action='store_true', help="Keep debug logging on while replaying")
+    replay_parser.set_defaults(func=bench_replay)
+
+    pipeline_parser = subparsers.add_parser('pipeline', help="Throughput of hamsh pipelines against the same pipelines run by /bin/sh")
+    pipeline_parser.add_argument('--gb', type=float, default=2, help="GiB pushed through each pipeline")
+    pipeline_parser.add_argument('--output-gb', type=float, default=1, help="GiB a single command writes to stdout")
+    pipeline_parser.add_argument('--runs', type=int, default=3)
+    pipeline_parser.set_defaults(func=bench_pipeline, backend='stub', model=None, stub_delay=0.0, kernel_args='')
+
+    completion_parser = subparsers.add_parser('completion', help="Tab completion latency with many generated commands")
+    completion_parser.add_argument('--commands', type=int, default=5000)
+    completion_parser.add_argument('--files', type=int, default=2000)
+    completion_parser.add_argument('--runs', type=int, default=1000)
+    completion_parser.set_defaults(func=bench_completion)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# Tab completion for hamsh, served from in-memory indexes so a keypress
+# does no more than a couple of stat calls:
+#
+#   commands  names in abin/, kept sorted and searched by prefix with
+#             bisect; rebuilt when the directory's mtime changes, which
+#             every publish does since it swaps a symlink in
+#   options   each script's argparse options, from hamnix_options
+#   paths     one directory listing per directory, cached until its mtime
+#             changes
+
+import os
+import bisect
+from hamnix_logger import setup_logger
+from hamnix_options import OptionIndex
+
+logger = setup_logger(__name__)
+
+MAX_PATH_CACHE = 256
+
+def prefixed(names, prefix):
+    # The entries of the sorted list names that start with prefix
+    start = bisect.bisect_left(names, prefix)
+    end = start
+    while end < len(names) and names[end].startswith(prefix):
+        end += 1
+    return names[start:end]
+
+class Completer:
+    def __init__(self, abin_path, option_index=None):
+        self.abin_path = abin_path
+        self.commands = []
+        self.commands_mtime = None
+        self.option_index = option_index or OptionIndex()
+        # directory -> (mtime, sorted names), directories ending in '/'
+        self.paths = {}
+        self.matches = []
+
+    def refresh_commands(self):
+        try:
+            mtime = os.stat(self.abin_path).st_mtime_ns
+        except OSError:
+            self.commands, self.commands_mtime = [], None
+            return
+        if mtime == self.commands_mtime:
+            return
+        self.commands = sorted(name for name in os.listdir(self.abin_path) if not name.startswith('.'))
+        self.commands_mtime = mtime
+        logger.debug(f"Indexed {len(self.commands)} commands for completion")
+
+    def complete_command(self, text):
+        self.refresh_commands()
+        return prefixed(self.commands, text)
+
+    def complete_option(self, command, text):
+        return prefixed(self.option_index.options(os.path.join(self.abin_path, command)) or [], text)
+
+    def complete_path(self, text):
+        directory, prefix = os.path.split(text)
+        listed = os.path.expanduser(directory) or '.'
+        try:
+            mtime = os.stat(listed).st_mtime_ns
+        except OSError:
+            return []
+        cached = self.paths.get(listed)
+        if cached is None or cached[0] != mtime:
+            try:
+                with os.scandir(listed) as entries:
+                    names = sorted(entry.name + '/' if entry.is_dir() else entry.name for entry in entries)
+            except OSError:
+                return []
+            if len(self.paths) >= MAX_PATH_CACHE:
+                self.paths.pop(next(iter(self.paths)))
+            cached = self.paths[listed] = (mtime, names)
+        # Hidden files only when asked for, as in bash
+        return [os.path.join(directory, name) for name in prefixed(cached[1], prefix)
+                if prefix.startswith('.') or not name.startswith('.')]
+
+    def candidates(self, line, text):
+        # line is everything before the word being completed
+        stage = line.rsplit('|', 1)[-1].split()
+        if not stage:
+            return self.complete_command(text)
+        if text.startswith('-') and stage[-1] not in ('<', '>', '2>'):
+            return self.complete_option(stage[0], text)
+        return self.complete_path(text)
+
+    def complete(self, line, text, state):
+        # readline calls this with state 0, 1, 2... until it gets None; the
+        # matches are worked out once, on state 0
+        if state == 0:
+            self.matches = self.candidates(line, text)
+        return self.matches[state] if state < len(self.matches) else None
@@ -0,0 +1,155 @@
+import os
+import json
+import time
+from collections import OrderedDict, deque
+from urllib.parse import quote
+from hamnix_logger import setup_logger
+
+logger = setup_logger(__name__)
+
+def estimate_tokens(text):
+    # Close enough for budgeting prompts without a tokenizer round trip
+    return len(text) // 4 + 1
+
+class Context:
+    def __init__(self):
+        self.entries = deque()
+        self.tokens = 0
+        self.bytes = 0
+        self.last_used = time.monotonic()
+
+    def append(self, text):
+        self.entries.append(text)
+        self.tokens += estimate_tokens(text)
+        self.bytes += len(text.encode())
+
+    def trim(self, max_tokens):
+        # Drops the oldest prompts until the context fits the budget, always
+        # keeping the newest one. Returns the number of prompts dropped.
+        dropped = 0
+        while self.tokens > max_tokens and len(self.entries) > 1:
+            text = self.entries.popleft()
+            self.tokens -= estimate_tokens(text)
+            self.bytes -= len(text.encode())
+            dropped += 1
+        return dropped
+
+class ContextStore:
+    # Prompt history per context, bounded three ways: each context keeps at
+    # most max_tokens of its newest prompts, at most max_contexts are kept in
+    # memory, and contexts idle for longer than idle_timeout seconds are
+    # dropped. Least recently used contexts go first.
+    #
+    # With persist_dir every context is also kept in
+    # <persist_dir>/<context>.jsonl, trimmed to the same budget, so
+    # get_prompt still works after a context was evicted or the kernel
+    # restarted.
+    def __init__(self, max_tokens=8192, max_contexts=64, idle_timeout=24 * 3600, persist_dir=None):
+        self.max_tokens = max_tokens
+        self.max_contexts = max_contexts
+        self.idle_timeout = idle_timeout
+        self.persist_dir = persist_dir
+        self.contexts = OrderedDict()
+        self.evictions = 0
+        self.trimmed = 0
+        if persist_dir:
+            os.makedirs(persist_dir, exist_ok=True)
+            logger.debug(f"Persisting contexts to {persist_dir}")
+
+    def path(self, context_id):
+        return os.path.join(self.persist_dir, quote(context_id, safe='') + '.jsonl')
+
+    def load(self, context_id):
+        if not self.persist_dir or not os.path.exists(self.path(context_id)):
+            return None
+        context = Context()
+        with open(self.path(context_id)) as f:
+            for line in f:
+                context.append(json.loads(line))
+        context.trim(self.max_tokens)
+        logger.debug(f"Loaded context {context_id} from disk: {len(context.entries)} prompts")
+        return context
+
+    def save(self, context_id, context, text=None):
+        # Appends one prompt, or rewrites the file when prompts were trimmed
+        if not self.persist_dir:
+            return
+        path = self.path(context_id)
+        if text is not None:
+            with open(path, 'a') as f:
+                f.write(json.dumps(text) + '\n')
+            return
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, 'w') as f:
+            for entry in context.entries:
+                f.write(json.dumps(entry) + '\n')
+        os.replace(tmp_path, path)
+
+    def touch(self, context_id, create=False):
+        self.evict_idle()
+        context = self.contexts.get(context_id)
+        if context is None:
+            context = self.load(context_id)
+            if context is None and not create:
+                return None
+            context = context or Context()
+            self.contexts[context_id] = context
+            self.evict_lru()
+        self.contexts.move_to_end(context_id)
+        context.last_used = time.monotonic()
+        return context
+
+    def ensure(self, context_id):
+        self.touch(context_id, create=True)
+
+    def append(self, context_id, text):
+        context = self.touch(context_id, create=True)
+        context.append(text)
+        dropped = context.trim(self.max_tokens)
+        self.trimmed += dropped
+        if dropped:
+            logger.debug(f"Trimmed {dropped} prompts from context {context_id}")
+            self.save(context_id, context)
+        else:
+            self.save(context_id, context, text)
+
+    def get(self, context_id):
+        context = self.touch(context_id)
+        return list(context.entries) if context else None
+
+    def evict_lru(self):
+        while len(self.contexts) > self.max_contexts:
+            context_id, _ = self.contexts.popitem(last=False)
+            self.evictions += 1
+            logger.debug(f"Evicted least recently used context {context_id}")
+
+    def evict_idle(self):
+        if not self.idle_timeout:
+            return
+        now = time.monotonic()
+        while self.contexts:
+            context_id, context = next(iter(self.contexts.items()))
+            if now - context.last_used < self.idle_timeout:
+                break
+            del self.contexts[context_id]
+            self.evictions += 1
+            logger.debug(f"Evicted idle context {context_id}")
+
+    def stats(self):
+        self.evict_idle()
+        now = time.monotonic()
+        return {
+            "contexts": len(self.contexts),
+            "max_contexts": self.max_contexts,
+            "max_tokens": self.max_tokens,
+            "tokens": sum(context.tokens for context in self.contexts.values()),
+            "bytes": sum(context.bytes for context in self.contexts.values()),
+            "evictions": self.evictions,
+            "trimmed": self.trimmed,
+            "per_context": {context_id: {
+                "prompts": len(context.entries),
+                "tokens": context.tokens,
+                "bytes": context.bytes,
+                "idle": round(now - context.last_used, 1),
+            } for context_id, context in self.contexts.items()},
+        }
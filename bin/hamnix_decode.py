@@ -0,0 +1,39 @@
+from hamnix_logger import setup_logger
+
+logger = setup_logger(__name__)
+
+def decode_stream(backend, token_ids, max_new_tokens=512):
+    # The prompt is prefilled once; every following step only feeds the last
+    # sampled token to the backend, which keeps its own KV cache in the state.
+    logger.debug(f"Starting incremental decode of {len(token_ids)} prompt tokens")
+    state = backend.prefill(token_ids)
+    for _ in range(max_new_tokens):
+        token = backend.sample(state)
+        yield token
+        if token == backend.eos_token_id:
+            break
+        state = backend.decode(state, token)
+
+class TextStream:
+    # Incremental detokenization for streaming: each push decodes only the
+    # tokens since the previous push plus the ones before them as context,
+    # not everything generated so far. The context keeps tokenizers that
+    # merge spaces or bytes across token boundaries from changing text that
+    # was already handed out.
+    def __init__(self, decode_tokens):
+        self.decode_tokens = decode_tokens
+        self.token_ids = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def push(self, tokens):
+        # The text the new tokens add; '' while they end inside a character
+        # that needs more tokens
+        self.token_ids.extend(tokens)
+        prefix_text = self.decode_tokens(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self.decode_tokens(self.token_ids[self.prefix_offset:])
+        if len(new_text) <= len(prefix_text) or new_text.endswith('\ufffd'):
+            return ''
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text):]
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+# Runs abin scripts by forking a process that already has the interpreter up,
+# the common stdlib modules imported and the script's bytecode compiled,
+# instead of starting a fresh python3 for every command.
+#
+# hamsh starts one server per shell. Each command is one connection on the
+# server's SOCK_SEQPACKET socket: the client sends the request with its
+# stdin/stdout/stderr fds attached (socket.send_fds), the server forks and
+# answers {"pid": ...}, then {"returncode": ...} once the child has exited.
+
+import os
+import sys
+import json
+import signal
+import socket
+import asyncio
+import hashlib
+import tempfile
+import selectors
+import builtins
+import traceback
+from collections import OrderedDict
+from hamnix_logger import setup_logger
+
+logger = setup_logger(__name__)
+
+PRELOAD_MODULES = [
+    'argparse', 'collections', 'datetime', 'fnmatch', 'functools', 'glob', 'io', 'itertools', 'json',
+    'locale', 'math', 'os', 'pathlib', 're', 'shutil', 'stat', 'string', 'subprocess', 'sys', 'textwrap', 'time',
+]
+CODE_CACHE_SIZE = 256
+MAX_REQUEST = 1 << 20
+
+class ForkServer:
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        # sha256 of the script source -> code object, or None for files that
+        # are not Python and get exec'd instead
+        self.code_cache = OrderedDict()
+        self.children = {}
+        self.selector = selectors.DefaultSelector()
+
+    def preload(self):
+        for name in PRELOAD_MODULES:
+            try:
+                __import__(name)
+            except ImportError:
+                pass
+
+    def compiled(self, path):
+        with open(path, 'rb') as f:
+            source = f.read()
+        digest = hashlib.sha256(source).hexdigest()
+        if digest in self.code_cache:
+            self.code_cache.move_to_end(digest)
+            return self.code_cache[digest]
+        logger.debug(f"Compiling {path} ({digest[:12]})")
+        try:
+            code = compile(source, path, 'exec')
+        except (SyntaxError, ValueError):
+            code = None
+        self.code_cache[digest] = code
+        while len(self.code_cache) > CODE_CACHE_SIZE:
+            self.code_cache.popitem(last=False)
+        return code
+
+    def serve(self):
+        self.preload()
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        listener.bind(self.socket_path)
+        listener.listen(64)
+        listener.setblocking(False)
+        wakeup_r, wakeup_w = os.pipe()
+        os.set_blocking(wakeup_r, False)
+        os.set_blocking(wakeup_w, False)
+        signal.set_wakeup_fd(wakeup_w)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        # Ctrl-C reaches the whole foreground process group; it is meant for
+        # the running command, not for the server
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.selector.register(listener, selectors.EVENT_READ, 'accept')
+        self.selector.register(wakeup_r, selectors.EVENT_READ, 'reap')
+        # stdin is a pipe from hamsh; EOF means the shell is gone
+        self.selector.register(sys.stdin.fileno(), selectors.EVENT_READ, 'exit')
+        # hamsh waits for this line before sending requests
+        print("ready", flush=True)
+        while True:
+            for key, _ in self.selector.select():
+                if key.data == 'exit':
+                    logger.debug("Shell exited, stopping fork server")
+                    return
+                elif key.data == 'accept':
+                    try:
+                        conn, _ = listener.accept()
+                    except BlockingIOError:
+                        continue
+                    self.handle(conn)
+                else:
+                    try:
+                        os.read(wakeup_r, 4096)
+                    except BlockingIOError:
+                        pass
+                    self.reap()
+
+    def handle(self, conn):
+        conn.setblocking(True)
+        try:
+            data, fds, _, _ = socket.recv_fds(conn, MAX_REQUEST, 3)
+            request = json.loads(data)
+            code = self.compiled(request['path'])
+        except Exception as e:
+            logger.error(f"Bad fork server request: {str(e)}")
+            self.reply(conn, {"error": str(e)})
+            conn.close()
+            return
+        pid = os.fork()
+        if pid == 0:
+            run_child(request, fds, code)
+        for fd in fds:
+            os.close(fd)
+        self.children[pid] = conn
+        logger.debug(f"Forked {pid} for {request['path']}")
+        self.reply(conn, {"pid": pid})
+
+    def reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            conn = self.children.pop(pid, None)
+            if conn is not None:
+                self.reply(conn, {"returncode": os.waitstatus_to_exitcode(status)})
+                conn.close()
+
+    @staticmethod
+    def reply(conn, message):
+        try:
+            conn.send(json.dumps(message).encode())
+        except OSError:
+            pass
+
+def run_child(request, fds, code):
+    # Runs in the forked child and never returns
+    try:
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+        os.closerange(3, os.sysconf('SC_OPEN_MAX'))
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        argv = [request['path']] + request['args']
+        if code is None:
+            os.execv(request['path'], argv)
+        sys.stdin = sys.__stdin__ = open(0, 'r', closefd=False)
+        sys.stdout = sys.__stdout__ = open(1, 'w', closefd=False)
+        sys.stderr = sys.__stderr__ = open(2, 'w', closefd=False, buffering=1, errors='backslashreplace')
+        sys.argv = argv
+        sys.path[0] = os.path.dirname(request['path'])
+        if 'random' in sys.modules:
+            sys.modules['random'].seed()
+    except BaseException:
+        traceback.print_exc()
+        os._exit(1)
+    os._exit(execute(code, request['path']))
+
+def execute(code, path):
+    # Mirrors how the interpreter runs a script: SystemExit sets the status,
+    # other exceptions print a traceback and exit 1, Ctrl-C kills by SIGINT
+    module = type(sys)('__main__')
+    module.__file__ = path
+    module.__builtins__ = builtins
+    sys.modules['__main__'] = module
+    status = 0
+    try:
+        exec(code, module.__dict__)
+    except SystemExit as e:
+        if e.code is None:
+            status = 0
+        elif isinstance(e.code, int):
+            status = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            status = 1
+    except KeyboardInterrupt:
+        traceback.print_exc()
+        flush_stdio()
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        os.kill(os.getpid(), signal.SIGINT)
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    try:
+        import atexit
+        atexit._run_exitfuncs()
+    except Exception:
+        pass
+    if not flush_stdio():
+        status = status or 120
+    return status & 0xff
+
+def flush_stdio():
+    flushed = True
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except (OSError, ValueError):
+            flushed = False
+    return flushed
+
+class ForkedProcess:
+    # The parts of asyncio.subprocess.Process that hamsh uses
+    def __init__(self, conn, pid, stdout=None, stderr=None):
+        self.conn = conn
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+
+    async def wait(self):
+        if self.returncode is None:
+            data = await asyncio.get_running_loop().sock_recv(self.conn, 4096)
+            self.conn.close()
+            # An empty read means the server went away with the child
+            self.returncode = json.loads(data)['returncode'] if data else -signal.SIGKILL
+        return self.returncode
+
+class ForkServerClient:
+    def __init__(self):
+        self.process = None
+        self.socket_path = None
+
+    async def start(self):
+        workdir = tempfile.mkdtemp(prefix='hamnix-forkserver-')
+        self.socket_path = os.path.join(workdir, 'forkserver.sock')
+        self.process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), self.socket_path,
+                                                            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+        line = await self.process.stdout.readline()
+        if line.strip() != b'ready':
+            raise RuntimeError("Fork server failed to start")
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def create_subprocess_exec(self, path, *args, stdin=None, stdout=None, stderr=None, env=None, cwd=None):
+        # stdin/stdout/stderr: None to inherit, a file descriptor, or
+        # asyncio.subprocess.PIPE (stdout and stderr only)
+        loop = asyncio.get_running_loop()
+        fds = [0 if stdin is None else stdin, 1, 2]
+        readers = [None, None]
+        close_after = []
+        for index, target in enumerate((stdout, stderr)):
+            if target == asyncio.subprocess.PIPE:
+                read_fd, write_fd = os.pipe()
+                readers[index] = await self.pipe_reader(read_fd)
+                fds[index + 1] = write_fd
+                close_after.append(write_fd)
+            elif target is not None:
+                fds[index + 1] = target
+        request = {'path': os.path.abspath(path), 'args': list(args), 'cwd': cwd or os.getcwd(),
+                   'env': dict(os.environ if env is None else env)}
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            conn.connect(self.socket_path)
+            socket.send_fds(conn, [json.dumps(request).encode()], fds)
+        finally:
+            for fd in close_after:
+                os.close(fd)
+        conn.setblocking(False)
+        reply = json.loads(await loop.sock_recv(conn, 4096) or b'{"error": "fork server closed the connection"}')
+        if 'error' in reply:
+            conn.close()
+            raise OSError(f"Fork server could not run {path}: {reply['error']}")
+        return ForkedProcess(conn, reply['pid'], *readers)
+
+    @staticmethod
+    async def pipe_reader(fd):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, 'rb', 0))
+        return reader
+
+    async def close(self):
+        if self.running:
+            self.process.stdin.close()
+            await self.process.wait()
+        if self.socket_path:
+            try:
+                os.unlink(self.socket_path)
+                os.rmdir(os.path.dirname(self.socket_path))
+            except OSError:
+                pass
+
+if __name__ == "__main__":
+    ForkServer(sys.argv[1]).serve()
@@ -3,114 +3,470 @@
 import os
 import sys
 import re
-import torch
+import time
+import signal
 import asyncio
+import argparse
 import json
-import stat
-from transformers import AutoTokenizer, AutoModelForCausalLM
 from hamnix_logger import setup_logger
-from hamnix_prompts import get_command_prompt, get_extend_command_prompt
+from hamnix_prompts import get_command_prompt, get_extend_command_prompt, get_extend_patch_prompt, COMMAND_PROMPT_PREFIX, EXTEND_COMMAND_PROMPT_PREFIX, EXTEND_PATCH_PROMPT_PREFIX, PROMPT_TEMPLATE_HASH
+from hamnix_prefix_cache import PrefixCache
+from hamnix_speculative import SpeculativeDecoder
+from hamnix_stopping import CodeBlockStopper
+from hamnix_decode import TextStream
+from hamnix_store import ScriptStore
+from hamnix_options import OptionIndex, requested_options
+from hamnix_scheduler import BatchScheduler
+from hamnix_workers import WorkerPool
+from hamnix_context import ContextStore
+from hamnix_validate import ScriptValidator
+from hamnix_patch import ScriptLayout, PatchError, merge_patch
+from hamnix_metrics import Metrics
+from hamnix_trace import TRACE_ID, tracer
+from hamnix_backends import BACKENDS, create_backend
+from hamnix_lib import KERNEL_SOCKET, process_memory
 
 logger = setup_logger(__name__)
 
 class HamnixKernel:
-    def __init__(self):
-        logger.debug("Initializing HamnixKernel")
-        self.tokenizer = AutoTokenizer.from_pretrained("deepseek-ai/deepseek-coder-6.7b-instruct", trust_remote_code=True)
-        logger.debug("Tokenizer loaded")
-        self.model = AutoModelForCausalLM.from_pretrained("deepseek-ai/deepseek-coder-6.7b-instruct", trust_remote_code=True, torch_dtype=torch.bfloat16).cuda()
-        logger.debug("Model loaded and moved to CUDA")
-        self.model.config.pad_token_id = self.model.config.eos_token_id
-        self.contexts = {'hamsh': []}  # Initialize with 'hamsh' context
-        self.queue = asyncio.Queue()
-        self.lock = asyncio.Lock()
+    def __init__(self, backend, max_batch_size=16, prefix_cache_bytes=512 * 1024 * 1024, draft_backend=None, speculative_k=4,
+                 num_workers=None, max_queued=64, contexts=None, candidates=1, extend_mode='patch'):
+        logger.debug(f"Initializing HamnixKernel with backend: {backend.name}")
+        self.backend = backend
+        self.draft_backend = draft_backend
+        # With a draft model every generation is decoded speculatively, one
+        # request at a time, instead of going through the batch scheduler
+        self.speculative = SpeculativeDecoder(backend, draft_backend, speculative_k) if draft_backend else None
+        self.started_at = time.perf_counter()
+        self.load_time = None
+        self.load_error = None
+        self.model_bytes = None
+        self.ready = asyncio.Event()
+        # Best-of-N: scripts sampled per request and checked before publishing
+        self.candidates = candidates
+        self.candidate_stats = {}
+        # 'patch' has the model write only the new arguments and handler code
+        # and merges them into the script; 'full' rewrites the whole script
+        self.extend_mode = extend_mode
+        self.patch_merges = 0
+        self.patch_fallbacks = 0
+        self.validator = ScriptValidator(max(1, min(candidates, os.cpu_count() or 1))) if candidates > 1 or extend_mode == 'patch' else None
+        self.prefix_cache = PrefixCache(backend, prefix_cache_bytes) if prefix_cache_bytes > 0 else None
+        self.scheduler = BatchScheduler(backend, max_batch_size, self.prefix_cache)
+        self.early_stops = 0
+        self.tokens_saved = 0
+        # (command, option signature) -> (task, progress listeners) for the
+        # generation currently running for that key
+        self.inflight = {}
+        self.dedup_hits = 0
+        self.dedup_tokens_saved = 0
+        # Latency histograms and counters for the stats task
+        self.metrics = Metrics()
+        self.speculative_tokens = 0
+        self.speculative_seconds = 0.0
+        self.contexts = contexts or ContextStore()
+        self.contexts.ensure('hamsh')  # Initialize with 'hamsh' context
+        # One worker per batch slot by default, so the queue only holds what
+        # the scheduler could not decode yet anyway
+        self.workers = WorkerPool(self.execute_task, num_workers or max_batch_size, max_queued)
         self.abin_path = os.path.abspath('./abin')
         os.makedirs(self.abin_path, exist_ok=True)
         logger.debug(f"Abin directory: {self.abin_path}")
+        self.store = ScriptStore(self.abin_path)
+        # Options and flags of the current scripts, to read request args with
+        self.option_index = OptionIndex()
         logger.debug("HamnixKernel initialization complete")
 
-    async def process_queue(self):
-        logger.debug("Starting to process queue")
+    async def load_backend(self):
+        # Runs in the background once the socket is up; cached scripts are
+        # served while the model is still loading.
+        logger.info(f"Loading backend: {self.backend.model_id}")
+        start = time.perf_counter()
+        try:
+            await self.scheduler.run_in_executor(self.backend.load)
+            if self.speculative:
+                logger.info(f"Loading draft backend: {self.draft_backend.model_id}")
+                await self.scheduler.run_in_executor(self.draft_backend.load)
+                self.speculative.check_compatible()
+        except Exception as e:
+            logger.error(f"Error loading backend: {str(e)}")
+            self.load_error = str(e)
+        else:
+            self.load_time = time.perf_counter() - start
+            if hasattr(self.backend, 'model_nbytes'):
+                self.model_bytes = self.backend.model_nbytes()
+            logger.info(f"Backend ready after {self.load_time:.2f}s ({time.perf_counter() - self.started_at:.2f}s since kernel start)")
+        self.ready.set()
+
+    async def close(self):
+        await self.workers.close()
+        if self.validator:
+            self.validator.close()
+        self.scheduler.close()
+
+    async def wait_ready(self):
+        if not self.ready.is_set():
+            logger.debug("Waiting for backend to finish loading")
+            await self.ready.wait()
+        if self.load_error:
+            raise RuntimeError(f"Model backend failed to load: {self.load_error}")
+
+    def health(self):
+        return json.dumps({"result": {
+            "ready": self.ready.is_set() and not self.load_error,
+            "backend": self.backend.name,
+            "model": self.backend.model_id,
+            "draft_model": self.draft_backend.model_id if self.draft_backend else None,
+            "load_time": self.load_time,
+            "quantize": getattr(self.backend, 'quantize', None),
+            "model_bytes": self.model_bytes,
+            "memory": process_memory(),
+            "uptime": time.perf_counter() - self.started_at,
+            "error": self.load_error,
+            "prefix_cache": self.prefix_cache.stats() if self.prefix_cache else None,
+            "early_stops": self.early_stops,
+            "tokens_saved": self.tokens_saved,
+            "inflight": len(self.inflight),
+            "dedup_hits": self.dedup_hits,
+            "dedup_tokens_saved": self.dedup_tokens_saved,
+            "workers": self.workers.stats(),
+            "contexts": self.contexts.stats(),
+            "candidates": self.candidates,
+            "extend_mode": self.extend_mode,
+            "patch_merges": self.patch_merges,
+            "patch_fallbacks": self.patch_fallbacks,
+            "candidate_stats": {command: dict(stats, pass_rate=stats["passed"] / stats["candidates"] if stats["candidates"] else None,
+                                              avg_seconds=stats["seconds"] / stats["rounds"])
+                                for command, stats in self.candidate_stats.items()},
+        }})
+
+    def stats(self):
+        # Tasks the worker pool turned away are counted there
+        self.metrics.set('errors', self.workers.rejected + self.workers.shed, kind='overloaded')
+        scheduler = self.scheduler
+        decode_seconds = scheduler.busy_seconds + self.speculative_seconds
+        decode_tokens = scheduler.tokens_generated + self.speculative_tokens
+        commands = self.metrics.counter('script_cache', result='hit') + self.metrics.counter('script_cache', result='miss')
+        proposed = self.metrics.counter('draft_tokens', result='proposed')
+        return {
+            "uptime": time.perf_counter() - self.started_at,
+            "queue": self.workers.stats(),
+            "inflight": len(self.inflight),
+            "tokens_generated": decode_tokens,
+            # Decode throughput while the model is busy, across the whole batch
+            "tokens_per_second": decode_tokens / decode_seconds if decode_seconds else None,
+            "decode_steps": scheduler.steps,
+            "prefix_cache": self.prefix_cache.stats() if self.prefix_cache else None,
+            # Share of the draft model's tokens the target model kept
+            "speculative_acceptance_rate": self.metrics.counter('draft_tokens', result='accepted') / proposed if proposed else None,
+            "dedup_hits": self.dedup_hits,
+            # Extends hamsh asked for because a script exited with status 2,
+            # per generate_command request
+            "exit_status_2_extend_rate": self.metrics.counter('extends', reason='exit_status_2') / commands if commands else None,
+            **self.metrics.snapshot(),
+        }
+
+    def gauges(self):
+        # Point-in-time values for the Prometheus dump
+        workers = self.workers.stats()
+        stats = self.stats()
+        return {
+            "queued_tasks": sum(workers['queued'].values()),
+            "running_tasks": workers['running'],
+            "inflight_generations": stats['inflight'],
+            "tokens_generated": stats['tokens_generated'],
+            "tokens_per_second": stats['tokens_per_second'],
+            "uptime_seconds": stats['uptime'],
+            "rss_bytes": process_memory()['rss_bytes'],
+        }
+
+    async def export_metrics(self, path, interval=15):
+        # Rewrites a Prometheus text file for node_exporter's textfile
+        # collector or anything else that scrapes files
+        logger.info(f"Writing metrics to {path} every {interval}s")
         while True:
-            logger.debug("Waiting for a task")
-            task = await self.queue.get()
-            logger.debug(f"Got task: {task}")
-            result = await self.execute_task(task)
-            self.queue.task_done()
-            logger.debug(f"Task completed with result: {result}")
-            return result
+            try:
+                # gauges() also brings the mirrored counters up to date
+                self.metrics.write_prometheus(path, self.gauges())
+            except OSError as e:
+                logger.error(f"Error writing metrics file: {str(e)}")
+            await asyncio.sleep(interval)
 
-    async def execute_task(self, task):
+    def error(self, kind, message):
+        self.metrics.inc('errors', kind=kind)
+        return json.dumps({"error": message})
+
+    async def execute_task(self, task, on_progress=None):
+        # Workers are long-lived tasks, so the trace id is set per task here
+        token = TRACE_ID.set(task.get('trace_id'))
+        try:
+            with tracer.span(f"execute {task['type']}", command=task.get('command')):
+                return await self.run_task(task, on_progress)
+        finally:
+            TRACE_ID.reset(token)
+
+    async def run_task(self, task, on_progress=None):
         logger.debug(f"Executing task: {task}")
-        async with self.lock:
-            if task['type'] == 'generate_command':
-                return await self.generate_command(task['command'], task['args'], task['context_id'], task.get('force_regenerate', False))
-            elif task['type'] == 'extend_command':
-                return await self.extend_command(task['command'], task['args'], task['context_id'])
-            elif task['type'] == 'switch_context':
-                return self.switch_context(task['context_id'])
-            elif task['type'] == 'get_prompt':
-                return self.get_prompt(task['context_id'])
-            else:
-                logger.warning(f"Unknown task type: {task['type']}")
-                return json.dumps({"error": f"Unknown task type: {task['type']}"})
+        # Generation requests are serialized by the batch scheduler, so
+        # concurrent sessions share decode steps. Everything else is answered
+        # by fast_path.
+        if task['type'] == 'generate_command':
+            return await self.single_flight(task['command'], task['args'], on_progress,
+                lambda progress: self.generate_command(task['command'], task['args'], task['context_id'], task.get('force_regenerate', False), progress))
+        elif task['type'] == 'extend_command':
+            self.metrics.inc('extends', reason=task.get('reason', 'unspecified'))
+            return await self.single_flight(task['command'], task['args'], on_progress,
+                lambda progress: self.extend_command(task['command'], task['args'], task['context_id'], progress))
+        result = self.fast_path(task)
+        if result is None:
+            logger.warning(f"Unknown task type: {task['type']}")
+            return self.error('unknown_task', f"Unknown task type: {task['type']}")
+        return result
+
+    def fast_path(self, task):
+        # Tasks that never touch the model are answered straight from
+        # handle_client, without the queue, so they stay fast while another
+        # session is generating.
+        if task.get('type') == 'health':
+            return self.health()
+        elif task.get('type') == 'stats':
+            return json.dumps({"result": self.stats()})
+        elif task.get('type') == 'trace':
+            # Chrome trace events recorded for one trace id, or all of them
+            return json.dumps({"result": tracer.trace_events(task.get('trace_id'))})
+        elif task.get('type') == 'switch_context':
+            return self.switch_context(task['context_id'])
+        elif task.get('type') == 'get_prompt':
+            return self.get_prompt(task['context_id'])
+        elif task.get('type') == 'list_versions':
+            return self.list_versions(task['command'])
+        elif task.get('type') == 'rollback_command':
+            return self.rollback_command(task['command'], task.get('version'))
+        elif task.get('type') == 'generate_command' and not task.get('force_regenerate', False):
+            command_path = self.cached_script(task['command'])
+            if command_path:
+                logger.debug(f"Cache hit for command: {command_path}")
+                self.metrics.inc('script_cache', result='hit')
+                return json.dumps({"result": command_path})
+        return None
+
+    async def single_flight(self, command, args, on_progress, start):
+        # Concurrent generate/extend requests for the same command and option
+        # set share one generation. Either kind of request produces a script
+        # handling those options, so a generate can attach to an extend and
+        # vice versa. Options are compared the way argparse reads them, so
+        # ls -la, ls -al and ls -l -a share a key, and so do head -n5 and
+        # head -n 5.
+        _, options, flags = self.option_index.entry(self.store.command_path(command))
+        key = (command, tuple(requested_options(args, options or (), flags or ())))
+        if key in self.inflight:
+            task, listeners = self.inflight[key]
+            self.dedup_hits += 1
+            logger.info(f"Attaching to in-flight generation for {key} ({self.dedup_hits} dedup hits)")
+            if on_progress:
+                listeners.append(on_progress)
+            with tracer.span('wait for in-flight generation', command=command):
+                result = await asyncio.shield(task)
+            current = self.store.current(command)
+            if current and current.get('tokens'):
+                self.dedup_tokens_saved += current['tokens']
+            return result
+
+        listeners = [on_progress] if on_progress else []
+
+        def broadcast(frame):
+            for listener in list(listeners):
+                listener(frame)
+
+        task = asyncio.ensure_future(start(broadcast))
+        self.inflight[key] = (task, listeners)
+        # Removed when the generation finishes rather than when this caller
+        # returns, so a disconnected client does not let a duplicate start
+        task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    def cached_script(self, command):
+        version = self.store.lookup(command, PROMPT_TEMPLATE_HASH, self.backend.model_id)
+        if version is None:
+            return None
+        return self.store.activate(command, version)
+
+    def list_versions(self, command):
+        current = self.store.current(command)
+        return json.dumps({"result": [dict(version, current=version is current) for version in self.store.versions(command)]})
+
+    def rollback_command(self, command, version=None):
+        try:
+            return json.dumps({"result": self.store.rollback(command, version)})
+        except (KeyError, ValueError) as e:
+            logger.error(f"Error rolling back command: {str(e)}")
+            return self.error('rollback', str(e))
 
     def switch_context(self, context_id):
         logger.debug(f"Switching to context: {context_id}")
-        if context_id not in self.contexts:
-            self.contexts[context_id] = []
+        self.contexts.ensure(context_id)
         return json.dumps({"result": f"Switched to context {context_id}"})
 
     def get_prompt(self, context_id):
         logger.debug(f"Getting prompt for context: {context_id}")
-        if context_id not in self.contexts:
+        prompts = self.contexts.get(context_id)
+        if prompts is None:
             logger.warning(f"Context not found: {context_id}")
-            return json.dumps({"error": "Context not found"})
-        return json.dumps({"result": "\n".join(self.contexts[context_id])})
+            return self.error('context_not_found', "Context not found")
+        return json.dumps({"result": "\n".join(prompts)})
+
+    def progress_reporter(self, on_progress):
+        # Turns the per-step token callbacks into token frames. The text was
+        # already decoded incrementally on the inference thread.
+        count = 0
+
+        def on_token(tokens, text):
+            nonlocal count
+            count += len(tokens)
+            on_progress({"type": "token", "tokens": count, "text": text})
+        return on_token
+
+    async def encode_prompt(self, messages, on_progress=None):
+        if on_progress and not self.ready.is_set():
+            on_progress({"type": "progress", "status": "waiting for model"})
+        with tracer.span('wait for model'):
+            await self.wait_ready()
+        with tracer.span('tokenize') as span:
+            token_ids = await self.scheduler.run_in_executor(self.backend.encode_chat, messages)
+            span['prompt_tokens'] = len(token_ids)
+        if on_progress:
+            on_progress({"type": "progress", "status": "generating", "prompt_tokens": len(token_ids)})
+        return token_ids
+
+    async def generate_text(self, messages, max_new_tokens=512, on_progress=None, prefix=None, task_type=None):
+        logger.debug("Generating response from model")
+        started = time.perf_counter()
+        token_ids = await self.encode_prompt(messages, on_progress)
+        on_token = self.progress_reporter(on_progress) if on_progress else None
+        return await self.sample_text(token_ids, max_new_tokens, on_token, prefix, task_type, started)
+
+    async def sample_text(self, token_ids, max_new_tokens=512, on_token=None, prefix=None, task_type=None, started=None, state=None):
+        # With task_type the time to first token and the generation time,
+        # both counted from started (the model wait and prompt encoding
+        # included), are recorded under that task type. state is token_ids
+        # already prefilled by the scheduler.
+        started = started or time.perf_counter()
+        first_token_at = None
 
-    async def generate_command(self, command, args, context_id, force_regenerate=False):
+        def on_step(tokens, text):
+            nonlocal first_token_at
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            if on_token:
+                on_token(tokens, text)
+
+        stopper = CodeBlockStopper(self.backend.decode_tokens)
+        with tracer.span('decode', speculative=bool(self.speculative)) as span:
+            if self.speculative:
+                generated = await self.speculative_generate(token_ids, max_new_tokens, on_step, stopper)
+            else:
+                generated = await self.scheduler.generate(token_ids, max_new_tokens, on_step, prefix, stopper, state)
+            span['tokens'] = len(generated)
+            if first_token_at is not None:
+                span['ttft_ms'] = round((first_token_at - started) * 1000, 3)
+        logger.debug(f"Response generated from model ({len(generated)} tokens)")
+        if task_type:
+            if first_token_at is not None:
+                self.metrics.observe('ttft_seconds', first_token_at - started, type=task_type)
+            self.metrics.observe('generation_seconds', time.perf_counter() - started, type=task_type)
+            self.metrics.inc('generated_tokens', len(generated), type=task_type)
+        if stopper.reason:
+            # Tokens the model was still allowed to produce, an upper bound on what stopping saved
+            saved = max_new_tokens - len(generated)
+            self.early_stops += 1
+            self.tokens_saved += saved
+            logger.info(f"Stopped generation at {stopper.reason} after {len(generated)} tokens, {saved} tokens of budget saved")
+            return stopper.text, len(generated)
+        return await self.scheduler.run_in_executor(self.backend.decode_tokens, generated), len(generated)
+
+    async def generate_script(self, command, messages, prefix, on_progress=None, max_new_tokens=512, task_type=None):
+        # Returns (code, tokens). In best-of-N mode the prompt is prefilled
+        # once, the candidates are decoded from that state together in one
+        # batch, each one is checked as soon as it finishes, and the first
+        # that passes wins; the others are cancelled.
+        if self.candidates <= 1 or self.speculative:
+            text, tokens = await self.generate_text(messages, max_new_tokens, on_progress, prefix, task_type)
+            return self.extract_python_code(text), tokens
+
+        started = time.perf_counter()
+        token_ids = await self.encode_prompt(messages, on_progress)
+        with tracer.span('prefill', candidates=self.candidates):
+            state = await self.scheduler.prefill(token_ids, prefix)
+        # Only the first candidate is streamed to the client
+        on_token = self.progress_reporter(on_progress) if on_progress else None
+
+        async def candidate(number):
+            # Latency is recorded for the streamed candidate only
+            text, tokens = await self.sample_text(token_ids, max_new_tokens, on_token if number == 0 else None, prefix,
+                                                  task_type if number == 0 else None, started, state)
+            code = self.extract_python_code(text)
+            if on_progress:
+                on_progress({"type": "progress", "status": f"checking candidate {number + 1}/{self.candidates}"})
+            with tracer.span('validate', candidate=number):
+                passed, reason = await self.validator.check(code)
+            return number, code, tokens, passed, reason
+
+        stats = self.candidate_stats.setdefault(command, {"rounds": 0, "candidates": 0, "passed": 0, "failed": 0, "seconds": 0.0})
+        stats["rounds"] += 1
+        tasks = [asyncio.create_task(candidate(number)) for number in range(self.candidates)]
+        fallback = None
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                number, code, tokens, passed, reason = await next_done
+                stats["candidates"] += 1
+                if passed:
+                    stats["passed"] += 1
+                    logger.info(f"Candidate {number + 1}/{self.candidates} for {command} passed after {time.perf_counter() - started:.2f}s")
+                    return code, tokens
+                stats["failed"] += 1
+                logger.info(f"Candidate {number + 1}/{self.candidates} for {command} failed: {reason}")
+                if fallback is None:
+                    fallback = (code, tokens)
+        finally:
+            for task in tasks:
+                task.cancel()
+            stats["seconds"] += time.perf_counter() - started
+        # Nothing passed; publish what the single-candidate mode would have
+        logger.warning(f"None of the {self.candidates} candidates for {command} passed the checks")
+        return fallback
+
+    async def speculative_generate(self, token_ids, max_new_tokens, on_token=None, stop=None):
+        loop = asyncio.get_running_loop()
+        # Token callbacks come from the inference thread, which also decodes
+        # the text they add
+        thread_on_token = None
+        if on_token:
+            stream = TextStream(self.backend.decode_tokens)
+            thread_on_token = lambda tokens: loop.call_soon_threadsafe(on_token, tokens, stream.push(tokens))
+        started = time.perf_counter()
+        generated, stats = await self.scheduler.run_in_executor(self.speculative.generate, token_ids, max_new_tokens, thread_on_token, stop)
+        self.speculative_seconds += time.perf_counter() - started
+        self.speculative_tokens += len(generated)
+        self.metrics.inc('draft_tokens', stats['proposed'], result='proposed')
+        self.metrics.inc('draft_tokens', stats['accepted'], result='accepted')
+        return generated
+
+    async def generate_command(self, command, args, context_id, force_regenerate=False, on_progress=None):
         logger.debug(f"Generating command: {command} with args: {args} for context: {context_id}")
-        command_path = os.path.join(self.abin_path, command)
-        
-        if not force_regenerate and os.path.exists(command_path):
+        command_path = None if force_regenerate else self.cached_script(command)
+        if command_path:
             logger.debug(f"Command already exists and force_regenerate is False, returning existing command: {command_path}")
+            self.metrics.inc('script_cache', result='hit')
             return json.dumps({"result": command_path})
+        self.metrics.inc('script_cache', result='miss')
 
-        if context_id not in self.contexts:
-            self.contexts[context_id] = []
         prompt = get_command_prompt(command, args)
-        self.contexts[context_id].append(prompt)
+        self.contexts.append(context_id, prompt)
 
         messages = [{'role': 'user', 'content': prompt}]
 
         try:
-            logger.debug("Generating response from model")
-            inputs = self.tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors="pt").to(self.model.device)
-            attention_mask = torch.ones_like(inputs)
-            attention_mask[inputs == self.tokenizer.pad_token_id] = 0
-            
-            generated = inputs[0].tolist()
-            with torch.no_grad():
-                for i in range(0, 512, 20):
-                    outputs = self.model.generate(
-                        torch.tensor([generated]).to(self.model.device),
-                        max_new_tokens=20,
-                        do_sample=True,
-                        top_k=50,
-                        top_p=0.95,
-                        num_return_sequences=1,
-                        pad_token_id=self.tokenizer.pad_token_id,
-                        eos_token_id=self.tokenizer.eos_token_id,
-                    )
-                    new_tokens = outputs[0][len(generated):]
-                    generated.extend(new_tokens.tolist())
-                    
-                    if self.tokenizer.eos_token_id in new_tokens:
-                        break
-
-            generated_text = self.tokenizer.decode(generated[len(inputs[0]):], skip_special_tokens=True)
-            logger.debug("Response generated from model")
-            script_code = self.extract_python_code(generated_text)
+            script_code, tokens = await self.generate_script(command, messages, COMMAND_PROMPT_PREFIX, on_progress, task_type='generate_command')
             
             if not script_code:
                 raise ValueError("No valid Python code was generated.")
@@ -120,79 +476,75 @@ class HamnixKernel:
             
             logger.debug("Command generation complete")
             
-            # Write the script to file
-            with open(command_path, 'w') as f:
-                f.write(script_code)
-            logger.debug(f"Wrote script to file: {command_path}")
-            
-            # Make the script executable
-            os.chmod(command_path, os.stat(command_path).st_mode | stat.S_IEXEC)
-            logger.debug(f"Made script executable: {command_path}")
+            with tracer.span('publish'):
+                command_path = self.store.publish(command, script_code, PROMPT_TEMPLATE_HASH, self.backend.model_id, tokens)
+            logger.debug(f"Published script: {command_path}")
             
             return json.dumps({"result": command_path})
         except Exception as e:
             logger.error(f"Error generating command: {str(e)}")
-            return json.dumps({"error": f"Error generating command: {str(e)}"})
+            return self.error('generate', f"Error generating command: {str(e)}")
 
-    async def extend_command(self, command, args, context_id):
+    async def extend_command(self, command, args, context_id, on_progress=None):
         logger.debug(f"Extending command: {command} with args: {args} for context: {context_id}")
-        command_path = os.path.join(self.abin_path, command)
-        
-        if not os.path.exists(command_path):
-            logger.error(f"Command file does not exist: {command_path}")
-            return json.dumps({"error": f"Command file does not exist: {command_path}"})
-
-        with open(command_path, 'r') as f:
-            existing_code = f.read()
+        current = self.store.current(command)
+        if current is None:
+            logger.error(f"Command does not exist: {command}")
+            return self.error('command_not_found', f"Command file does not exist: {self.store.command_path(command)}")
 
-        prompt = get_extend_command_prompt(command, args, existing_code)
-        self.contexts[context_id].append(prompt)
-
-        messages = [{'role': 'user', 'content': prompt}]
+        existing_code = self.store.read(current)
 
         try:
-            logger.debug("Generating response from model")
-            inputs = self.tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors="pt").to(self.model.device)
-            attention_mask = torch.ones_like(inputs)
-            attention_mask[inputs == self.tokenizer.pad_token_id] = 0
-            
-            generated = inputs[0].tolist()
-            with torch.no_grad():
-                for i in range(0, 512, 20):
-                    outputs = self.model.generate(
-                        torch.tensor([generated]).to(self.model.device),
-                        max_new_tokens=20,
-                        do_sample=True,
-                        top_k=50,
-                        top_p=0.95,
-                        num_return_sequences=1,
-                        pad_token_id=self.tokenizer.pad_token_id,
-                        eos_token_id=self.tokenizer.eos_token_id,
-                    )
-                    new_tokens = outputs[0][len(generated):]
-                    generated.extend(new_tokens.tolist())
-                    
-                    if self.tokenizer.eos_token_id in new_tokens:
-                        break
-
-            generated_text = self.tokenizer.decode(generated[len(inputs[0]):], skip_special_tokens=True)
-            logger.debug("Response generated from model")
-            updated_code = self.extract_python_code(generated_text)
+            updated_code, tokens, source = None, 0, 'extend'
+            if self.extend_mode == 'patch':
+                try:
+                    updated_code, tokens = await self.patch_command(command, args, context_id, existing_code, on_progress)
+                    source = 'patch'
+                except PatchError as e:
+                    self.patch_fallbacks += 1
+                    self.metrics.inc('errors', kind='patch')
+                    logger.warning(f"Patch extension of {command} failed, rewriting the whole script: {str(e)}")
+
+            if updated_code is None:
+                prompt = get_extend_command_prompt(command, args, existing_code)
+                self.contexts.append(context_id, prompt)
+                messages = [{'role': 'user', 'content': prompt}]
+                updated_code, tokens = await self.generate_script(command, messages, EXTEND_COMMAND_PROMPT_PREFIX, on_progress, task_type='extend_command')
             
             if not updated_code:
                 raise ValueError("No valid Python code was generated.")
             
             logger.debug("Command extension complete")
             
-            # Write the updated script to file
-            with open(command_path, 'w') as f:
-                f.write(updated_code)
-            logger.debug(f"Wrote updated script to file: {command_path}")
+            with tracer.span('publish', source=source):
+                command_path = self.store.publish(command, updated_code, PROMPT_TEMPLATE_HASH, self.backend.model_id, tokens,
+                                                  source=source)
+            logger.debug(f"Published updated script: {command_path}")
             
             return json.dumps({"result": command_path})
         except Exception as e:
             logger.error(f"Error extending command: {str(e)}")
-            return json.dumps({"error": f"Error extending command: {str(e)}"})
+            return self.error('extend', f"Error extending command: {str(e)}")
+
+    async def patch_command(self, command, args, context_id, existing_code, on_progress=None):
+        # The model only writes what changes, so decoding cost follows the
+        # size of the change rather than the size of the script. Raises
+        # PatchError when the patch cannot be merged or the result fails the
+        # script checks.
+        layout = ScriptLayout(existing_code)
+        prompt = get_extend_patch_prompt(command, args, existing_code, layout.parser, layout.args)
+        self.contexts.append(context_id, prompt)
+        messages = [{'role': 'user', 'content': prompt}]
+        generated_text, tokens = await self.generate_text(messages, on_progress=on_progress, prefix=EXTEND_PATCH_PROMPT_PREFIX, task_type='extend_command')
+        with tracer.span('merge patch'):
+            merged = merge_patch(existing_code, self.extract_python_code(generated_text), args)
+        with tracer.span('validate'):
+            passed, reason = await self.validator.check(merged)
+        if not passed:
+            raise PatchError(f"merged script failed its checks: {reason}")
+        self.patch_merges += 1
+        logger.info(f"Merged a {tokens}-token patch into {command}")
+        return merged, tokens
 
     @staticmethod
     def extract_python_code(text):
@@ -205,7 +557,31 @@ class HamnixKernel:
             return match.group(0)
         return text
 
-kernel = HamnixKernel()
+kernel = None
+
+TASK_TYPES = ('generate_command', 'extend_command', 'switch_context', 'get_prompt', 'health', 'stats', 'trace', 'list_versions', 'rollback_command')
+
+HEARTBEAT_INTERVAL = 5
+
+async def stream_task(message, writer):
+    # Streaming mode: token and progress frames while the task runs, a
+    # heartbeat every few seconds so the client can reset its timeout, then
+    # one final frame carrying the result or error.
+    def send_frame(frame):
+        writer.write(json.dumps(frame).encode() + b'\n')
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            send_frame({"type": "heartbeat"})
+            await writer.drain()
+
+    heartbeats = asyncio.create_task(heartbeat())
+    try:
+        result = await kernel.workers.submit(message, send_frame)
+    finally:
+        heartbeats.cancel()
+    return result
 
 async def handle_client(reader, writer):
     logger.info("New client connected")
@@ -218,14 +594,28 @@ async def handle_client(reader, writer):
                     break
                 message = json.loads(data.decode().strip())
                 logger.debug(f"Received message: {message}")
-                await kernel.queue.put(message)
-                result = await kernel.process_queue()
+                started = time.perf_counter()
+                token = TRACE_ID.set(message.get('trace_id'))
+                try:
+                    # Time between this span and the execute span is queueing
+                    with tracer.span(f"request {message.get('type')}", command=message.get('command')) as span:
+                        result = kernel.fast_path(message)
+                        span['fast_path'] = result is not None
+                        if result is None and message.get('stream'):
+                            result = await stream_task(message, writer)
+                        elif result is None:
+                            result = await kernel.workers.submit(message)
+                finally:
+                    TRACE_ID.reset(token)
                 
                 # Ensure the result is a valid JSON string
                 try:
                     json.loads(result)  # This will raise an exception if result is not valid JSON
                 except json.JSONDecodeError:
-                    result = json.dumps({"error": "Invalid JSON response from kernel"})
+                    result = kernel.error('invalid_response', "Invalid JSON response from kernel")
+                # Total latency as the client sees it, queueing included
+                task_type = message.get('type')
+                kernel.metrics.observe('request_seconds', time.perf_counter() - started, type=task_type if task_type in TASK_TYPES else 'unknown')
                 
                 # Send the response with a newline at the end
                 writer.write(result.encode() + b'\n')
@@ -237,12 +627,12 @@ async def handle_client(reader, writer):
                 break
             except json.JSONDecodeError as e:
                 logger.error(f"Invalid JSON received: {e}")
-                error_response = json.dumps({"error": "Invalid JSON in request"}) + '\n'
+                error_response = kernel.error('invalid_request', "Invalid JSON in request") + '\n'
                 writer.write(error_response.encode())
                 await writer.drain()
             except Exception as e:
                 logger.error(f"Error handling client request: {str(e)}")
-                error_response = json.dumps({"error": str(e)}) + '\n'
+                error_response = kernel.error('internal', str(e)) + '\n'
                 writer.write(error_response.encode())
                 await writer.drain()
     except ConnectionResetError:
@@ -254,13 +644,80 @@ async def handle_client(reader, writer):
         writer.close()
         await writer.wait_closed()
 
-async def start_server():
+async def start_server(socket_path=KERNEL_SOCKET, metrics_file=None, metrics_interval=15):
     logger.info("Starting server")
-    server = await asyncio.start_unix_server(handle_client, '/tmp/hamnix_kernel.sock')
-    logger.info("Server started, listening on /tmp/hamnix_kernel.sock")
+    server = await asyncio.start_unix_server(handle_client, socket_path)
+    logger.info(f"Server started, listening on {socket_path} after {time.perf_counter() - kernel.started_at:.3f}s")
+    loading = asyncio.create_task(kernel.load_backend())
+    if metrics_file:
+        exporting = asyncio.create_task(kernel.export_metrics(metrics_file, metrics_interval))
+    # SIGTERM and Ctrl-C shut down cleanly, so the script checker's pool
+    # processes exit with the kernel instead of outliving it
+    stopping = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        asyncio.get_running_loop().add_signal_handler(signum, stopping.set)
     async with server:
-        await server.serve_forever()
+        await stopping.wait()
+    logger.info("Shutting down")
+    await kernel.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Hamnix kernel")
+    parser.add_argument('--backend', choices=list(BACKENDS), default=os.environ.get('HAMNIX_BACKEND', 'hf'),
+                        help="Model backend (default: $HAMNIX_BACKEND or hf)")
+    parser.add_argument('--model', default=os.environ.get('HAMNIX_MODEL'),
+                        help="Model name or path for the hf and tiny backends (default: $HAMNIX_MODEL)")
+    parser.add_argument('--device', default=os.environ.get('HAMNIX_DEVICE'),
+                        help="Torch device, e.g. cpu or cuda (default: $HAMNIX_DEVICE or autodetect)")
+    parser.add_argument('--dtype', choices=['bfloat16', 'float16', 'float32'], default=os.environ.get('HAMNIX_DTYPE'),
+                        help="Model weight dtype (default: $HAMNIX_DTYPE, or bfloat16 on CUDA and float32 on CPU)")
+    parser.add_argument('--quantize', choices=['int8', 'int4'], default=os.environ.get('HAMNIX_QUANTIZE'),
+                        help="Load quantized weights: int8 dynamic quantization or 4-bit weight-only on CPU, bitsandbytes on CUDA (default: $HAMNIX_QUANTIZE)")
+    parser.add_argument('--stub-delay', type=float, default=float(os.environ.get('HAMNIX_STUB_DELAY', 0)),
+                        help="Seconds per decode step for the stub backend")
+    parser.add_argument('--max-batch-size', type=int, default=16,
+                        help="Maximum number of generations decoded together in one batch")
+    parser.add_argument('--prefix-cache-mb', type=int, default=512,
+                        help="Memory for cached prompt-prefix KV states, 0 to disable")
+    parser.add_argument('--draft-model', default=os.environ.get('HAMNIX_DRAFT_MODEL'),
+                        help="Small model sharing the main model's tokenizer, enables speculative decoding (default: $HAMNIX_DRAFT_MODEL)")
+    parser.add_argument('--speculative-k', type=int, default=4,
+                        help="Draft tokens proposed per speculative decoding step")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Tasks run concurrently by the kernel (default: --max-batch-size)")
+    parser.add_argument('--max-queued', type=int, default=64,
+                        help="Tasks waiting for a worker before new ones are rejected")
+    parser.add_argument('--context-tokens', type=int, default=8192,
+                        help="Approximate tokens of prompt history kept per context")
+    parser.add_argument('--max-contexts', type=int, default=64,
+                        help="Contexts kept in memory, least recently used ones are evicted")
+    parser.add_argument('--context-idle', type=float, default=24,
+                        help="Hours after which an idle context is evicted, 0 to keep them")
+    parser.add_argument('--context-dir', default=os.environ.get('HAMNIX_CONTEXT_DIR'),
+                        help="Directory to persist contexts in, so get_prompt survives eviction and restarts (default: $HAMNIX_CONTEXT_DIR)")
+    parser.add_argument('--candidates', type=int, default=1,
+                        help="Scripts sampled per generation; with more than one, the first that parses and runs --help is published")
+    parser.add_argument('--extend-mode', choices=['patch', 'full'], default='patch',
+                        help="How scripts are extended: 'patch' generates only the new code and merges it, falling back to 'full', which regenerates the whole script")
+    parser.add_argument('--metrics-file', default=os.environ.get('HAMNIX_METRICS_FILE'),
+                        help="Periodically write metrics in Prometheus text format to this file (default: $HAMNIX_METRICS_FILE)")
+    parser.add_argument('--metrics-interval', type=float, default=15,
+                        help="Seconds between metrics file updates")
+    parser.add_argument('--socket', default=KERNEL_SOCKET, help=f"Unix socket path (default: {KERNEL_SOCKET})")
+    args = parser.parse_args()
+    if args.draft_model and args.backend == 'stub':
+        parser.error("--draft-model needs the hf or tiny backend")
+    if args.draft_model and args.candidates > 1:
+        parser.error("--candidates needs the batch scheduler and cannot be combined with --draft-model")
+    return args
 
 if __name__ == "__main__":
+    args = parse_args()
     logger.info("Starting Hamnix Kernel")
-    asyncio.run(start_server())
+    draft_backend = create_backend(args.backend, args.draft_model, args.device, dtype=args.dtype, quantize=args.quantize) if args.draft_model else None
+    kernel = HamnixKernel(create_backend(args.backend, args.model, args.device, args.stub_delay, args.dtype, args.quantize), args.max_batch_size,
+                          args.prefix_cache_mb * 1024 * 1024, draft_backend, args.speculative_k,
+                          args.workers, args.max_queued,
+                          ContextStore(args.context_tokens, args.max_contexts, args.context_idle * 3600, args.context_dir),
+                          args.candidates, args.extend_mode)
+    asyncio.run(start_server(args.socket, args.metrics_file, args.metrics_interval))
@@ -1,7 +1,9 @@
 import os
 import asyncio
 import json
+import resource
 from hamnix_logger import setup_logger
+from hamnix_trace import TRACE_ID, tracer
 
 logger = setup_logger(__name__)
 
@@ -9,40 +11,68 @@ logger = setup_logger(__name__)
 ABIN_PATH = os.path.abspath('./abin')
 os.makedirs(ABIN_PATH, exist_ok=True)
 logger.debug(f"Abin directory: {ABIN_PATH}")
+KERNEL_SOCKET = os.environ.get('HAMNIX_KERNEL_SOCKET', '/tmp/hamnix_kernel.sock')
+# Identifies this shell to the kernel, which queues requests fairly per session
+SESSION_ID = f"hamsh-{os.getpid()}"
 
-async def communicate_with_kernel(message, timeout=30, retries=3):
+def process_memory():
+    # Current and peak resident set size of this process in bytes
+    with open('/proc/self/statm') as f:
+        rss_pages = int(f.read().split()[1])
+    return {
+        "rss_bytes": rss_pages * os.sysconf('SC_PAGE_SIZE'),
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+async def communicate_with_kernel(message, timeout=30, retries=3, on_frame=None):
+    # With on_frame the kernel streams token/progress/heartbeat frames before
+    # the final result; timeout then applies to the gap between frames.
     logger.debug(f"Communicating with kernel: {message}")
+    if on_frame:
+        message = dict(message, stream=True)
+    if TRACE_ID.get():
+        message = dict(message, trace_id=TRACE_ID.get())
+    with tracer.span(f"kernel {message.get('type')}", command=message.get('command')):
+        return await send_to_kernel(message, timeout, retries, on_frame)
+
+async def send_to_kernel(message, timeout, retries, on_frame):
     for attempt in range(retries):
         try:
-            reader, writer = await asyncio.open_unix_connection('/tmp/hamnix_kernel.sock')
+            reader, writer = await asyncio.open_unix_connection(KERNEL_SOCKET)
             logger.debug("Connected to kernel socket")
             writer.write(json.dumps(message).encode() + b'\n')  # Add newline to signal end of message
             await writer.drain()
             logger.debug("Sent message to kernel")
 
-            # Read the entire response with a timeout
-            data = b''
-            try:
-                data = await asyncio.wait_for(reader.readuntil(b'\n'), timeout=timeout)
-            except asyncio.TimeoutError:
-                logger.warning(f"Timeout reached while reading response from kernel")
-                if data:
-                    logger.warning(f"Partial data received: {data}")
-                raise
+            while True:
+                # Read the next frame with a timeout
+                data = b''
+                try:
+                    data = await asyncio.wait_for(reader.readuntil(b'\n'), timeout=timeout)
+                except asyncio.TimeoutError:
+                    logger.warning(f"Timeout reached while reading response from kernel")
+                    if data:
+                        logger.warning(f"Partial data received: {data}")
+                    raise
+
+                if not data:
+                    raise Exception("No data received from kernel")
+
+                try:
+                    response = json.loads(data.decode().strip())
+                except json.JSONDecodeError as e:
+                    logger.error(f"Failed to parse JSON response: {e}")
+                    raise Exception(f"Invalid JSON response from kernel: {data.decode()}")
+
+                if "result" in response or "error" in response:
+                    break
+                if on_frame:
+                    on_frame(response)
 
             logger.debug(f"Received data from kernel: {data}")
             writer.close()
             await writer.wait_closed()
             
-            if not data:
-                raise Exception("No data received from kernel")
-            
-            try:
-                response = json.loads(data.decode().strip())
-            except json.JSONDecodeError as e:
-                logger.error(f"Failed to parse JSON response: {e}")
-                raise Exception(f"Invalid JSON response from kernel: {data.decode()}")
-            
             if "error" in response:
                 raise Exception(response["error"])
             return response["result"]
@@ -57,12 +87,16 @@ async def communicate_with_kernel(message, timeout=30, retries=3):
             logger.error(f"Error communicating with kernel: {str(e)}")
             raise
 
-async def extend_script(command, args):
+async def extend_script(command, args, on_frame=None, reason=None):
+    # reason says what triggered the extension, for the kernel's stats
     logger.debug(f"Extending script for command: {command} with args: {args}")
     message = {
         'type': 'extend_command',
         'command': command,
         'args': args,
-        'context_id': 'hamsh'
+        'context_id': 'hamsh',
+        'session_id': SESSION_ID
     }
-    return await communicate_with_kernel(message)
+    if reason:
+        message['reason'] = reason
+    return await communicate_with_kernel(message, on_frame=on_frame)
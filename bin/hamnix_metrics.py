@@ -0,0 +1,125 @@
+import os
+import bisect
+from hamnix_logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Seconds; wide enough for cache hits (sub-millisecond) and slow generations
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120]
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # counts[i] observations <= buckets[i], the last slot is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + [float('inf')], self.counts):
+            seen += count
+            if seen >= rank:
+                return bound if bound != float('inf') else self.buckets[-1]
+        return self.buckets[-1]
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+class Metrics:
+    # Counters and latency histograms, each keyed by name and labels, e.g.
+    # metrics.inc('errors', kind='generate') or
+    # metrics.observe('ttft_seconds', 0.4, type='generate_command').
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        series = self.counters.setdefault(name, {})
+        key = label_key(labels)
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        # For counters kept elsewhere and mirrored here
+        self.counters.setdefault(name, {})[label_key(labels)] = value
+
+    def observe(self, name, value, **labels):
+        series = self.histograms.setdefault(name, {})
+        key = label_key(labels)
+        if key not in series:
+            series[key] = Histogram()
+        series[key].observe(value)
+
+    def counter(self, name, **labels):
+        return self.counters.get(name, {}).get(label_key(labels), 0)
+
+    def total(self, name):
+        return sum(self.counters.get(name, {}).values())
+
+    def snapshot(self):
+        # {name: {"label=value,...": value}} with "" for unlabelled series
+        def series_name(key):
+            return ','.join(f'{name}={value}' for name, value in key)
+        return {
+            "counters": {name: {series_name(key): value for key, value in series.items()}
+                         for name, series in self.counters.items()},
+            "histograms": {name: {series_name(key): histogram.snapshot() for key, histogram in series.items()}
+                           for name, series in self.histograms.items()},
+        }
+
+    def prometheus(self, gauges=None, prefix='hamnix_'):
+        # Prometheus text exposition format; gauges is {name: value} for
+        # point-in-time values such as queue depth
+        lines = []
+        for name, series in sorted(self.counters.items()):
+            lines.append(f"# TYPE {prefix}{name}_total counter")
+            for key, value in sorted(series.items()):
+                lines.append(f"{prefix}{name}_total{format_labels(key)} {value}")
+        for name, series in sorted(self.histograms.items()):
+            lines.append(f"# TYPE {prefix}{name} histogram")
+            for key, histogram in sorted(series.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    lines.append(f"{prefix}{name}_bucket{format_labels(key, [('le', bound)])} {cumulative}")
+                lines.append(f"{prefix}{name}_sum{format_labels(key)} {histogram.sum}")
+                lines.append(f"{prefix}{name}_count{format_labels(key)} {histogram.count}")
+        for name, value in sorted((gauges or {}).items()):
+            if value is None:
+                continue
+            lines.append(f"# TYPE {prefix}{name} gauge")
+            lines.append(f"{prefix}{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path, gauges=None):
+        # Written to a temporary file and renamed, so a scraper never reads a
+        # partial dump
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus(gauges))
+        os.replace(tmp_path, path)
@@ -0,0 +1,151 @@
+# The options each abin script accepts, read statically from its argparse
+# calls, and the options a command line asks for, read the way argparse
+# would. hamsh completes options from it and checks a command's arguments
+# before running it, so a script that lacks an option is extended up front
+# instead of after it has started and exited with status 2. The kernel uses
+# the same parsing for patch checks and for coalescing requests.
+
+import os
+import re
+import ast
+from hamnix_logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# argparse adds these to every parser
+DEFAULT_OPTIONS = {'-h', '--help'}
+# Actions whose options take no value
+FLAG_ACTIONS = {'store_true', 'store_false', 'store_const', 'append_const', 'count', 'help', 'version'}
+# argparse treats these as values, not options
+NEGATIVE_NUMBER = re.compile(r'^-\d+$|^-\d*\.\d+$')
+
+def option_strings(call):
+    return [arg.value for arg in call.args if isinstance(arg, ast.Constant) and isinstance(arg.value, str) and arg.value.startswith('-')]
+
+def declared_options(tree):
+    options = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == 'add_argument':
+            options.update(option_strings(node))
+    return options
+
+def flag_options(tree):
+    flags = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == 'add_argument':
+            for keyword in node.keywords:
+                if keyword.arg == 'action' and isinstance(keyword.value, ast.Constant) and keyword.value.value in FLAG_ACTIONS:
+                    flags.update(option_strings(node))
+    return flags
+
+def script_options(code):
+    # (declared options, those of them that take no value), or None when
+    # they cannot be told statically: no ArgumentParser, parse_known_args,
+    # other prefix characters, or option strings that are not literals
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        return None
+    parsers = False
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        func = node.func
+        name = func.attr if isinstance(func, ast.Attribute) else getattr(func, 'id', None)
+        if name == 'ArgumentParser':
+            parsers = True
+            if any(keyword.arg == 'prefix_chars' for keyword in node.keywords):
+                return None
+        elif name == 'parse_known_args':
+            return None
+        elif name == 'add_argument' and not all(isinstance(arg, ast.Constant) for arg in node.args):
+            return None
+    if not parsers:
+        return None
+    return parser_options(tree)
+
+def parser_options(tree):
+    # (declared options, those that take no value), with argparse's own
+    return declared_options(tree) | DEFAULT_OPTIONS, flag_options(tree) | {'-h'}
+
+def option_names(arg, options=(), flags=()):
+    # The options argparse reads arg as, given a script's options and flags:
+    # --opt=value is --opt, and -abc is -a followed by -b and -c while each
+    # takes no value, the rest being the value of the first one that does
+    # (-n5 is -n, -d: is -d). A letter the script does not declare counts
+    # as a flag when another letter follows it, so -la is -l and -a.
+    name = arg.split('=', 1)[0]
+    if name.startswith('--') or name in options:
+        return [name]
+    names = []
+    for index in range(1, len(name)):
+        option = '-' + name[index]
+        names.append(option)
+        if option in flags:
+            continue
+        if option in options or not name[index + 1:index + 2].isalpha():
+            break
+    return names
+
+def requested_options(args, options=(), flags=()):
+    # Sorted option names args asks for, up to a "--"
+    names = set()
+    for arg in args:
+        if arg == '--':
+            break
+        if arg.startswith('-') and arg != '-' and not NEGATIVE_NUMBER.match(arg):
+            names.update(option_names(arg, options, flags))
+    return sorted(names)
+
+def unknown_options(options, args, flags=()):
+    # Options in args that argparse would reject, erring towards accepting
+    unknown = []
+    for name in requested_options(args, options, flags):
+        if name.startswith('--'):
+            # Any prefix of a long option is accepted as an abbreviation
+            known = any(option.startswith(name) for option in options)
+        else:
+            known = name in options
+        if not known:
+            unknown.append(name)
+    return unknown
+
+class OptionIndex:
+    # Keyed by script path, such as the abin/<command> paths the kernel
+    # resolves, so it does not depend on the directory it was created in
+    def __init__(self):
+        # path -> ((inode, mtime) of the script, sorted options or None,
+        # options that take no value)
+        self.entries = {}
+
+    def options(self, path):
+        # Sorted options of the script at path, None when unknown
+        return self.entry(path)[1]
+
+    def entry(self, path):
+        try:
+            # Follows the symlink, so a new version has a new inode
+            stat = os.stat(path)
+        except OSError:
+            return None, None, None
+        version = (stat.st_ino, stat.st_mtime_ns)
+        entry = self.entries.get(path)
+        if entry is None or entry[0] != version:
+            try:
+                with open(path) as f:
+                    declared = script_options(f.read())
+            except (OSError, UnicodeDecodeError):
+                declared = None
+            if declared is None:
+                entry = (version, None, None)
+            else:
+                entry = (version, sorted(declared[0]), declared[1])
+            self.entries[path] = entry
+            logger.debug(f"Indexed options of {path}: {entry[1]}")
+        return entry
+
+    def unknown(self, path, args):
+        _, options, flags = self.entry(path)
+        if options is None:
+            return []
+        return unknown_options(options, args, flags)
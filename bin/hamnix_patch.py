@@ -0,0 +1,179 @@
+import ast
+from hamnix_logger import setup_logger
+from hamnix_options import option_strings, declared_options, flag_options, parser_options, requested_options, unknown_options
+
+logger = setup_logger(__name__)
+
+class PatchError(Exception):
+    pass
+
+def blocks(node):
+    # Every statement list under node, nested ones included
+    for field in ('body', 'orelse', 'finalbody'):
+        body = getattr(node, field, None)
+        if isinstance(body, list) and body and isinstance(body[0], ast.stmt):
+            yield body
+            for statement in body:
+                yield from blocks(statement)
+    for handler in getattr(node, 'handlers', []):
+        yield from blocks(handler)
+    for case in getattr(node, 'cases', []):
+        yield from blocks(case)
+
+def method_call(statement, name):
+    # The receiver name of a `receiver.name(...)` expression statement or
+    # `target = receiver.name(...)` assignment, otherwise None
+    value = statement.value if isinstance(statement, (ast.Expr, ast.Assign)) else None
+    if (isinstance(value, ast.Call) and isinstance(value.func, ast.Attribute) and value.func.attr == name
+            and isinstance(value.func.value, ast.Name)):
+        return value.func.value.id
+    return None
+
+class ScriptLayout:
+    # Where a patch goes in an argparse script: new arguments after the last
+    # add_argument on the parser, handler code right after parse_args, new
+    # functions before the top-level statement that parses the arguments.
+    def __init__(self, code):
+        try:
+            self.tree = ast.parse(code)
+        except SyntaxError as e:
+            raise PatchError(f"existing script does not parse: {e.msg}")
+        self.parse_args = None
+        for body in blocks(self.tree):
+            for statement in body:
+                if isinstance(statement, ast.Assign) and len(statement.targets) == 1 and isinstance(statement.targets[0], ast.Name) \
+                        and method_call(statement, 'parse_args'):
+                    if self.parse_args is not None:
+                        raise PatchError("script parses its arguments more than once")
+                    self.parse_args = statement
+        if self.parse_args is None:
+            raise PatchError("script has no `args = parser.parse_args()`")
+        self.parser = method_call(self.parse_args, 'parse_args')
+        self.args = self.parse_args.targets[0].id
+        self.last_argument = None
+        for body in blocks(self.tree):
+            for statement in body:
+                if method_call(statement, 'add_argument') == self.parser and isinstance(statement, ast.Expr):
+                    if self.last_argument is None or statement.end_lineno > self.last_argument.end_lineno:
+                        self.last_argument = statement
+        self.options = declared_options(self.tree)
+        self.flags = flag_options(self.tree)
+        self.main = next(statement for statement in self.tree.body
+                         if statement.lineno <= self.parse_args.lineno <= statement.end_lineno)
+        self.functions = {statement.name: statement for statement in self.tree.body
+                          if isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef))}
+        imports = [statement for statement in self.tree.body if isinstance(statement, (ast.Import, ast.ImportFrom))]
+        self.last_import = imports[-1] if imports else None
+
+def first_line(statement):
+    return min([statement.lineno] + [decorator.lineno for decorator in getattr(statement, 'decorator_list', [])])
+
+def indent(lines, prefix):
+    return [prefix + line if line.strip() else line for line in lines]
+
+def is_main_guard(statement):
+    return isinstance(statement, ast.If) and '__name__' in ast.dump(statement.test) and '__main__' in ast.dump(statement.test)
+
+def checked(code, required_options):
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        raise PatchError(f"merged script does not parse: line {e.lineno}: {e.msg}")
+    options, flags = parser_options(tree)
+    missing = unknown_options(options, required_options, flags)
+    if missing:
+        raise PatchError(f"merged script does not declare {', '.join(missing)}")
+    return code
+
+def merge_patch(code, patch, args=()):
+    # Splices a patch (new add_argument calls, handler statements, new or
+    # replaced top-level functions and imports) into the script and returns
+    # the merged code. Raises PatchError when the patch cannot be applied or
+    # the result does not accept the options args asks for.
+    layout = ScriptLayout(code)
+    # Read with the existing script's flags, so -la asks for -l and -a
+    required_options = requested_options(args, layout.options, layout.flags)
+    try:
+        patch_tree = ast.parse(patch)
+    except SyntaxError as e:
+        raise PatchError(f"patch does not parse: line {e.lineno}: {e.msg}")
+    patch_lines = patch.splitlines()
+
+    # Models sometimes answer with the whole updated script anyway
+    if any(is_main_guard(statement) or (isinstance(statement, ast.Assign) and method_call(statement, 'parse_args'))
+           for statement in patch_tree.body):
+        logger.debug("Patch is a complete script, using it as is")
+        return checked(patch, required_options)
+
+    def source(statement):
+        return patch_lines[first_line(statement) - 1:statement.end_lineno]
+
+    imports, arguments, handler, functions = [], [], [], []
+    for statement in patch_tree.body:
+        if isinstance(statement, (ast.Import, ast.ImportFrom)):
+            imports.append(statement)
+        elif isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            functions.append(statement)
+        elif isinstance(statement, ast.Expr) and method_call(statement, 'add_argument'):
+            arguments.append(statement)
+        else:
+            handler.append(statement)
+    if not (arguments or handler or functions):
+        raise PatchError("patch is empty")
+
+    lines = code.splitlines()
+    # (start, end, lines) replacing lines[start:end], an insertion when
+    # start == end. Applied bottom-up so earlier edits do not shift later
+    # ones; of two insertions at the same line the one added first ends up
+    # first.
+    edits = []
+
+    new_imports = []
+    existing_imports = set(ast.dump(statement) for statement in layout.tree.body if isinstance(statement, (ast.Import, ast.ImportFrom)))
+    for statement in imports:
+        if ast.dump(statement) not in existing_imports:
+            new_imports += source(statement)
+    if new_imports:
+        position = layout.last_import.end_lineno if layout.last_import else (1 if lines and lines[0].startswith('#!') else 0)
+        edits.append((position, position, new_imports))
+
+    new_arguments = []
+    for statement in arguments:
+        options = option_strings(statement.value)
+        if options and set(options) <= layout.options:
+            logger.debug(f"Skipping already declared argument {options}")
+            continue
+        argument_lines = source(statement)
+        # The patch may call the parser something else
+        receiver = method_call(statement, 'add_argument')
+        argument_lines[0] = argument_lines[0].replace(f"{receiver}.add_argument", f"{layout.parser}.add_argument", 1)
+        new_arguments += argument_lines
+    anchor = layout.last_argument or layout.parse_args
+    position = layout.last_argument.end_lineno if layout.last_argument else layout.parse_args.lineno - 1
+    if new_arguments:
+        edits.append((position, position, indent(new_arguments, ' ' * anchor.col_offset)))
+
+    if handler:
+        handler_lines = [line for statement in handler for line in source(statement)]
+        position = layout.parse_args.end_lineno
+        edits.append((position, position, indent(handler_lines, ' ' * layout.parse_args.col_offset)))
+
+    for statement in functions:
+        replaced = layout.functions.get(statement.name)
+        if replaced is layout.main and (new_arguments or handler):
+            # The new arguments and handler would land in the replaced code
+            raise PatchError(f"patch replaces {statement.name} and also adds code to it")
+        if replaced is not None:
+            edits.append((first_line(replaced) - 1, replaced.end_lineno, source(statement)))
+        else:
+            position = first_line(layout.main) - 1
+            edits.append((position, position, source(statement) + ['', '']))
+
+    for _, (start, end, new_lines) in sorted(enumerate(edits), key=lambda edit: (edit[1][0], edit[1][1], edit[0]), reverse=True):
+        lines[start:end] = new_lines
+    merged = '\n'.join(lines) + '\n'
+
+    checked(merged, required_options)
+    logger.debug(f"Merged patch: {len(new_arguments)} argument lines, {len(handler)} handler statements, "
+                 f"{len(functions)} functions, {len(new_imports)} import lines")
+    return merged
@@ -0,0 +1,83 @@
+from collections import OrderedDict
+from hamnix_logger import setup_logger
+
+logger = setup_logger(__name__)
+
+class PrefixCache:
+    # KV states for the shared leading tokens of the prompt templates, keyed
+    # by the exact prefix token ids. Bounded by the bytes the states hold,
+    # evicting the least recently used prefix first. Only touched from the
+    # inference thread.
+    def __init__(self, backend, max_bytes):
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes_used = 0
+        self.prefix_encodings = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def prefix_length(self, prefix, token_ids):
+        # Number of leading prompt tokens that belong to the shared prefix.
+        # The prefix is rendered through the same chat template on its own,
+        # so template header tokens are part of it, and only the tokens both
+        # encodings agree on are used in case the tokenizer merged across the
+        # boundary.
+        if prefix not in self.prefix_encodings:
+            self.prefix_encodings[prefix] = self.backend.encode_chat([{'role': 'user', 'content': prefix}])
+        prefix_ids = self.prefix_encodings[prefix]
+        length = 0
+        for a, b in zip(prefix_ids, token_ids):
+            if a != b:
+                break
+            length += 1
+        # Always leave at least one token for the request's own prefill
+        return min(length, len(token_ids) - 1)
+
+    def get(self, prefix_ids):
+        key = tuple(prefix_ids)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+        self.misses += 1
+        return None
+
+    def put(self, prefix_ids, state):
+        key = tuple(prefix_ids)
+        size = self.backend.state_nbytes(state)
+        if size > self.max_bytes:
+            logger.debug(f"Prefix of {len(key)} tokens ({size} bytes) is larger than the cache, not caching")
+            return
+        if key in self.entries:
+            self.bytes_used -= self.entries.pop(key)[1]
+        while self.entries and self.bytes_used + size > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.bytes_used -= evicted_size
+            self.evictions += 1
+        self.entries[key] = (state, size)
+        self.bytes_used += size
+        logger.debug(f"Cached prefix of {len(key)} tokens ({size} bytes, {self.bytes_used}/{self.max_bytes} used)")
+
+    def prefill(self, token_ids, prefix_length):
+        # Prefill a prompt, reusing (or creating) the cached state for its
+        # first prefix_length tokens
+        if prefix_length <= 0:
+            return self.backend.prefill(token_ids)
+        prefix_ids = token_ids[:prefix_length]
+        state = self.get(prefix_ids)
+        if state is None:
+            state = self.backend.prefill(prefix_ids)
+            self.put(prefix_ids, state)
+        return self.backend.prefill(token_ids[prefix_length:], state)
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes_used,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -1,10 +1,12 @@
-def get_command_prompt(command, args):
-    return f"""
-Create a Python script that mimics the '{command}' Unix command.
+import hashlib
+
+# The fixed instructions come first so every prompt of a kind shares the same
+# leading tokens; the kernel keeps the KV cache for that prefix and only
+# prefills the command-specific part.
+COMMAND_PROMPT_PREFIX = """
+Create a Python script that mimics a Unix command.
 
 Requirements:
-- Name: {command}
-- Arguments: {args}
 - Use standard library modules only
 - Handle errors gracefully, writing to stderr
 - Design for use in a bash environment (support piping, redirection)
@@ -14,16 +16,11 @@ Requirements:
 Provide only the Python code, no explanations.
 """
 
-def get_extend_command_prompt(command, args, existing_code):
-    return f"""
-Extend the existing Python script for the '{command}' command to handle new arguments: {args}
-
-Existing code:
-{existing_code}
+EXTEND_COMMAND_PROMPT_PREFIX = """
+Extend an existing Python script that mimics a Unix command so it handles new arguments.
 
 Requirements:
 - Maintain existing functionality
-- Add support for new arguments: {args}
 - Use argparse for all options (new and existing)
 - Handle errors gracefully, writing to stderr
 - Design for use in a bash environment (support piping, redirection)
@@ -31,3 +28,51 @@ Requirements:
 
 Provide only the complete, updated Python code, no explanations.
 """
+
+EXTEND_PATCH_PROMPT_PREFIX = """
+Extend an existing Python script that mimics a Unix command so it handles new arguments, by writing only the code to add.
+
+Reply with a Python code block containing only:
+- parser.add_argument(...) calls for the new options
+- statements handling the new options; they run right after the arguments are parsed
+- complete new versions of any top-level functions that must change; they replace the existing ones
+- imports the new code needs
+
+Requirements:
+- Do not repeat unchanged code
+- Use standard library modules only
+- Handle errors gracefully, writing to stderr
+- Exit with appropriate status codes: 0 for success, non-zero for errors, excluding 2 as it is used by argparse for unknown options
+
+Provide only the Python code, no explanations.
+"""
+
+def get_command_prompt(command, args):
+    return COMMAND_PROMPT_PREFIX + f"""
+The script mimics the '{command}' Unix command.
+- Name: {command}
+- Arguments: {args}
+"""
+
+def get_extend_command_prompt(command, args, existing_code):
+    return EXTEND_COMMAND_PROMPT_PREFIX + f"""
+Extend the existing Python script for the '{command}' command to handle new arguments: {args}
+
+Existing code:
+{existing_code}
+"""
+
+def get_extend_patch_prompt(command, args, existing_code, parser_name, args_name):
+    return EXTEND_PATCH_PROMPT_PREFIX + f"""
+Extend the existing Python script for the '{command}' command to handle new arguments: {args}
+The parser is `{parser_name}` and the parsed arguments are in `{args_name}`.
+
+Existing code:
+{existing_code}
+"""
+
+# Identifies the prompt templates a script was generated with
+PROMPT_TEMPLATE_HASH = hashlib.sha256(
+    (get_command_prompt('{command}', '{args}') + get_extend_command_prompt('{command}', '{args}', '{existing_code}')
+     + get_extend_patch_prompt('{command}', '{args}', '{existing_code}', '{parser_name}', '{args_name}')).encode()
+).hexdigest()[:16]
@@ -0,0 +1,199 @@
+import time
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from hamnix_logger import setup_logger
+from hamnix_decode import TextStream
+
+logger = setup_logger(__name__)
+
+class GenerationRequest:
+    def __init__(self, token_ids, max_new_tokens, on_token=None, prefix=None, stop=None, state=None):
+        self.token_ids = token_ids
+        self.prefix = prefix
+        self.stop = stop
+        self.max_new_tokens = max_new_tokens
+        self.on_token = on_token
+        self.notified = 0
+        # An already prefilled prompt; admission skips the prefill
+        self.initial_state = state
+        # Decoded on the inference thread when someone listens; text holds
+        # what has not been handed to on_token yet
+        self.text_stream = None
+        self.text = ''
+        self.state = None
+        self.generated = []
+        self.future = asyncio.get_running_loop().create_future()
+        self.submitted_at = time.perf_counter()
+        self.first_token_at = None
+        self.finished_at = None
+
+class BatchScheduler:
+    # Continuous batching: every decode step runs all in-flight sequences as a
+    # single padded batch. New requests are prefilled and join between steps,
+    # finished sequences leave the batch as soon as they hit EOS or their limit.
+    def __init__(self, backend, max_batch_size=16, prefix_cache=None):
+        self.backend = backend
+        self.prefix_cache = prefix_cache
+        self.max_batch_size = max_batch_size
+        self.pending = deque()
+        self.active = []
+        self.wakeup = asyncio.Event()
+        self.task = None
+        # All backend calls run on this one thread so decoding never blocks
+        # the event loop and the backend is never used concurrently.
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='hamnix-inference')
+        self.steps = 0
+        self.tokens_generated = 0
+        # Wall time spent in batch steps, for tokens per second while busy
+        self.busy_seconds = 0.0
+
+    async def generate(self, token_ids, max_new_tokens=512, on_token=None, prefix=None, stop=None, state=None):
+        # prefix is the fixed prompt text shared with other requests; its KV
+        # state comes from the prefix cache when one is configured. stop is
+        # called on the inference thread with the tokens generated so far and
+        # ends the sequence early when it returns True. on_token is called on
+        # the event loop after each step with the new tokens and the text
+        # they add. state is token_ids already prefilled by prefill(), which
+        # several requests can start from: states are never changed in place.
+        request = GenerationRequest(token_ids, max_new_tokens, on_token, prefix, stop, state)
+        if on_token is not None:
+            request.text_stream = TextStream(self.backend.decode_tokens)
+        self.pending.append(request)
+        self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return await request.future
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.executor.shutdown(wait=False)
+
+    async def run_in_executor(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def prefill(self, token_ids, prefix=None):
+        # For sampling several sequences from one prompt: prefill it once and
+        # pass the state to each generate call
+        return await self.run_in_executor(self.prefill_prompt, token_ids, prefix)
+
+    def prefill_prompt(self, token_ids, prefix=None):
+        if self.prefix_cache is not None and prefix:
+            prefix_length = self.prefix_cache.prefix_length(prefix, token_ids)
+            return self.prefix_cache.prefill(token_ids, prefix_length)
+        return self.backend.prefill(token_ids)
+
+    async def run(self):
+        logger.debug("Batch scheduler started")
+        while True:
+            if not self.pending and not self.active:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            # Sequences whose caller went away (e.g. losing best-of-N
+            # candidates) stop taking batch slots
+            if any(request.future.done() for request in self.active):
+                self.active = [request for request in self.active if not request.future.done()]
+                logger.debug(f"Dropped cancelled requests ({len(self.active)} active)")
+            # Admission happens here on the event loop; the executor thread
+            # only ever sees the requests handed to it for this step.
+            admitted = []
+            while self.pending and len(self.active) + len(admitted) < self.max_batch_size:
+                request = self.pending.popleft()
+                if not request.future.done():
+                    admitted.append(request)
+            started = time.perf_counter()
+            finished = await self.run_in_executor(self.step, admitted)
+            self.busy_seconds += time.perf_counter() - started
+            for request in self.active:
+                self.notify(request)
+            for request, result in finished:
+                if request.future.done():
+                    continue
+                self.notify(request)
+                if isinstance(result, Exception):
+                    request.future.set_exception(result)
+                else:
+                    request.future.set_result(result)
+
+    def notify(self, request):
+        # Called on the event loop between steps with the tokens produced
+        # since the last call
+        if request.on_token is None or len(request.generated) <= request.notified:
+            return
+        tokens = request.generated[request.notified:]
+        text = request.text
+        request.notified = len(request.generated)
+        request.text = ''
+        try:
+            request.on_token(tokens, text)
+        except Exception as e:
+            logger.error(f"Error in token callback: {str(e)}")
+
+    def admit(self, admitted, finished):
+        for request in admitted:
+            try:
+                if request.initial_state is not None:
+                    request.state = request.initial_state
+                    request.initial_state = None
+                else:
+                    request.state = self.prefill_prompt(request.token_ids, request.prefix)
+            except Exception as e:
+                logger.error(f"Error prefilling request: {str(e)}")
+                finished.append((request, e))
+                continue
+            self.active.append(request)
+            logger.debug(f"Request joined batch ({len(self.active)} active, {len(self.pending)} pending)")
+
+    def step(self, admitted):
+        # Runs on the inference thread. Returns (request, result) pairs for the
+        # event loop to resolve, since futures are not thread-safe.
+        finished = []
+        self.admit(admitted, finished)
+        try:
+            self.decode_step(finished)
+        except Exception as e:
+            logger.error(f"Error in batch decode step: {str(e)}")
+            finished.extend((request, e) for request in self.active)
+            self.active = []
+        for request in self.active + [request for request, _ in finished]:
+            self.stream_text(request)
+        return finished
+
+    def stream_text(self, request):
+        # Detokenizing stays on this thread with the rest of the tokenizer
+        # use, and only the text delta goes back to the event loop
+        stream = request.text_stream
+        if stream is not None and len(request.generated) > len(stream.token_ids):
+            request.text += stream.push(request.generated[len(stream.token_ids):])
+
+    def decode_step(self, finished):
+        if not self.active:
+            return
+        continuing = []
+        for request in self.active:
+            token = self.backend.sample(request.state)
+            request.generated.append(token)
+            if request.first_token_at is None:
+                request.first_token_at = time.perf_counter()
+            if (token == self.backend.eos_token_id or len(request.generated) >= request.max_new_tokens
+                    or (request.stop is not None and request.stop(request.generated))):
+                self.finish(request)
+                finished.append((request, request.generated))
+            else:
+                continuing.append(request)
+        self.steps += 1
+        self.tokens_generated += len(self.active)
+        if continuing:
+            states = self.backend.decode_batch([request.state for request in continuing],
+                                               [request.generated[-1] for request in continuing])
+            for request, state in zip(continuing, states):
+                request.state = state
+        self.active = continuing
+
+    def finish(self, request):
+        request.finished_at = time.perf_counter()
+        request.state = None
+        logger.debug(f"Request left batch after {len(request.generated)} tokens "
+                     f"(time to first token {request.first_token_at - request.submitted_at:.3f}s, "
+                     f"total {request.finished_at - request.submitted_at:.3f}s)")
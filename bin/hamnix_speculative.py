@@ -0,0 +1,111 @@
+import time
+from hamnix_logger import setup_logger
+from hamnix_backends import torch
+
+logger = setup_logger(__name__)
+
+class SpeculativeDecoder:
+    # Speculative sampling: the draft model proposes k tokens one at a time,
+    # the target model scores all of them in a single forward pass and each
+    # draft token is accepted with probability min(1, p/q). The first
+    # rejected position is resampled from the leftover target distribution,
+    # so the output follows the target model's sampling distribution.
+    #
+    # The last committed token is kept out of both caches ("pending") and fed
+    # as the first token of the next verify pass, which is what produces the
+    # target distribution for the next draft token.
+    def __init__(self, target, draft, k=4):
+        self.target = target
+        self.draft = draft
+        self.k = k
+        self.eos_token_id = target.eos_token_id
+
+    def check_compatible(self):
+        if self.target.tokenizer.get_vocab() != self.draft.tokenizer.get_vocab():
+            raise ValueError(f"Draft model {self.draft.model_id} does not share the tokenizer of {self.target.model_id}")
+
+    def distributions(self, p, q):
+        # Models of one family often pad their embeddings to different sizes
+        vocab_size = min(p.size(-1), q.size(-1))
+        return p[..., :vocab_size], q[..., :vocab_size]
+
+    def generate(self, token_ids, max_new_tokens=512, on_token=None, stop=None):
+        start = time.perf_counter()
+        pending = token_ids[-1]
+        target_state = self.target.prefill(token_ids[:-1])
+        draft_state = self.draft.prefill(token_ids[:-1])
+        generated = []
+        proposed = accepted = target_passes = 0
+        stopped = False
+
+        while not stopped and len(generated) < max_new_tokens and (not generated or generated[-1] != self.eos_token_id):
+            base_length = target_state.length
+            # Draft k tokens, starting from the pending token
+            draft_tokens = []
+            draft_probs = []
+            state = self.draft.decode(draft_state, pending)
+            for i in range(self.k):
+                q = self.draft.probs(state.logits)[0]
+                token = torch.multinomial(q, num_samples=1).item()
+                draft_tokens.append(token)
+                draft_probs.append(q)
+                if i < self.k - 1:
+                    state = self.draft.decode(state, token)
+
+            # Score the pending token and all draft tokens in one target pass
+            logits, verified_state = self.target.verify(target_state, [pending] + draft_tokens)
+            target_passes += 1
+            proposed += len(draft_tokens)
+
+            new_tokens = []
+            for i, token in enumerate(draft_tokens):
+                p, q = self.distributions(self.target.probs(logits[i]), draft_probs[i])
+                if token < p.size(-1) and torch.rand(1).item() < min(1.0, (p[token] / q[token]).item()):
+                    new_tokens.append(token)
+                    accepted += 1
+                    if token == self.eos_token_id:
+                        break
+                    continue
+                residual = torch.clamp(p - q, min=0)
+                if residual.sum() <= 0:
+                    residual = p
+                new_tokens.append(torch.multinomial(residual / residual.sum(), num_samples=1).item())
+                break
+            else:
+                # Every draft token was accepted; the target's next token is free
+                new_tokens.append(torch.multinomial(self.target.probs(logits[-1]), num_samples=1).item())
+
+            new_tokens = new_tokens[:max_new_tokens - len(generated)]
+            if stop is not None:
+                for i in range(len(new_tokens)):
+                    if stop(generated + new_tokens[:i + 1]):
+                        new_tokens = new_tokens[:i + 1]
+                        stopped = True
+                        break
+            generated.extend(new_tokens)
+            if on_token:
+                on_token(new_tokens)
+
+            # Both caches keep the old pending token plus the accepted draft
+            # tokens; the last new token becomes the pending one
+            committed = base_length + len(new_tokens)
+            target_state = self.target.truncate(verified_state, committed)
+            if committed > state.length:
+                state = self.draft.decode(state, draft_tokens[-1])
+            draft_state = self.draft.truncate(state, committed)
+            pending = new_tokens[-1]
+
+        elapsed = time.perf_counter() - start
+        acceptance_rate = accepted / proposed if proposed else 0.0
+        logger.info(f"Speculative decode: {len(generated)} tokens in {elapsed:.2f}s "
+                    f"({len(generated) / elapsed:.2f} tokens/sec), acceptance rate {acceptance_rate:.2%}, "
+                    f"{len(generated) / max(target_passes, 1):.2f} tokens per target pass")
+        return generated, {
+            "tokens": len(generated),
+            "proposed": proposed,
+            "accepted": accepted,
+            "acceptance_rate": acceptance_rate,
+            "target_passes": target_passes,
+            "tokens_per_target_pass": len(generated) / max(target_passes, 1),
+            "seconds": elapsed,
+        }
@@ -0,0 +1,57 @@
+import re
+import ast
+from hamnix_logger import setup_logger
+from hamnix_decode import TextStream
+
+logger = setup_logger(__name__)
+
+OPENING_FENCE = re.compile(r'```[\w+-]*\n')
+
+class CodeBlockStopper:
+    # Stop condition for script generation, checked after every new token.
+    # Decoding ends as soon as a fenced code block closes or, when the model
+    # writes the script without a fence, once a complete module ending in an
+    # `if __name__ == "__main__":` block is followed by a new top-level line.
+    # Everything after that is explanation the prompt asked not to get.
+    def __init__(self, decode_tokens):
+        # Only the new tokens are decoded on each call
+        self.stream = TextStream(decode_tokens)
+        self.decoded = ''
+        self.check_next = False
+        self.reason = None
+        self.text = None
+
+    def __call__(self, token_ids):
+        piece = self.stream.push(token_ids[len(self.stream.token_ids):])
+        self.decoded += piece
+        if not (self.check_next or '`' in piece or '\n' in piece):
+            return False
+        text = self.decoded
+        self.check_next = text.endswith('\n')
+        opening = OPENING_FENCE.search(text)
+        if opening:
+            closing = text.find('```', opening.end())
+            if closing != -1:
+                return self.stop('closing code fence', text[:closing + 3])
+            return False
+        if '`' in text:
+            return False
+        return self.check_module(text)
+
+    def check_module(self, text):
+        code, _, current_line = text.rpartition('\n')
+        if not current_line or current_line[0].isspace() or '__name__' not in code:
+            return False
+        try:
+            module = ast.parse(code)
+        except SyntaxError:
+            return False
+        last = module.body[-1] if module.body else None
+        if isinstance(last, ast.If) and '__name__' in ast.unparse(last.test):
+            return self.stop('complete module', code + '\n')
+        return False
+
+    def stop(self, reason, text):
+        self.reason = reason
+        self.text = text
+        return True
@@ -0,0 +1,168 @@
+import os
+import ast
+import json
+import time
+import hashlib
+from hamnix_logger import setup_logger
+from hamnix_options import declared_options
+
+logger = setup_logger(__name__)
+
+def script_options(code):
+    # Options the script declares to argparse, recorded with each version
+    try:
+        return sorted(declared_options(ast.parse(code)))
+    except (SyntaxError, ValueError):
+        return []
+
+class ScriptStore:
+    # Content-addressed store for generated scripts.
+    #
+    #   abin/.store/objects/<sha256>  immutable script contents
+    #   abin/.store/index.json        every version of every command
+    #   abin/<command>                symlink to the current version
+    #
+    # Versions are looked up by (command, prompt template hash, model id), so
+    # a prompt or model change generates a new script instead of reusing one
+    # made for something else. Publishing writes the object and swaps the
+    # symlink with os.replace, so a reader never sees a half-written script,
+    # and old versions stay around for rollback.
+    def __init__(self, abin_path):
+        self.abin_path = abin_path
+        self.store_path = os.path.join(abin_path, '.store')
+        self.objects_path = os.path.join(self.store_path, 'objects')
+        self.index_path = os.path.join(self.store_path, 'index.json')
+        os.makedirs(self.objects_path, exist_ok=True)
+        self.commands = {}
+        self.keys = {}
+        self.current_versions = {}
+        self.load_index()
+        self.import_legacy_scripts()
+
+    def load_index(self):
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.commands = json.load(f).get('commands', {})
+        for command, entry in self.commands.items():
+            for version in entry['versions']:
+                self.keys[(command, version['prompt_hash'], version['model'])] = version
+                if version['hash'] == entry['current']:
+                    self.current_versions[command] = version
+        logger.debug(f"Loaded script index with {len(self.commands)} commands")
+
+    def save_index(self):
+        tmp_path = f"{self.index_path}.tmp-{os.getpid()}"
+        with open(tmp_path, 'w') as f:
+            json.dump({'commands': self.commands}, f, indent=1)
+        os.replace(tmp_path, self.index_path)
+
+    def import_legacy_scripts(self):
+        # Plain files left in abin/ from before the store. They have no prompt
+        # or model recorded and match any key for their command.
+        imported = False
+        for name in os.listdir(self.abin_path):
+            path = os.path.join(self.abin_path, name)
+            if name.startswith('.') or name in self.commands or os.path.islink(path) or not os.path.isfile(path):
+                continue
+            with open(path) as f:
+                code = f.read()
+            logger.info(f"Importing existing script into the store: {name}")
+            self.publish(name, code, None, None, source='imported', save=False)
+            imported = True
+        if imported:
+            self.save_index()
+
+    def command_path(self, command):
+        return os.path.join(self.abin_path, command)
+
+    def lookup(self, command, prompt_hash, model):
+        # O(1): the current version if it fits the key (so rollbacks stick),
+        # else the latest version for the key, else a legacy script
+        current = self.current_versions.get(command)
+        if current and (current['prompt_hash'], current['model']) in ((prompt_hash, model), (None, None)):
+            return current
+        return self.keys.get((command, prompt_hash, model)) or self.keys.get((command, None, None))
+
+    def current(self, command):
+        return self.current_versions.get(command)
+
+    def read(self, version):
+        with open(self.object_path(version['hash'])) as f:
+            return f.read()
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_path, digest)
+
+    def write_object(self, code):
+        digest = hashlib.sha256(code.encode()).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            tmp_path = f"{path}.tmp-{os.getpid()}"
+            with open(tmp_path, 'w') as f:
+                f.write(code)
+            os.chmod(tmp_path, 0o755)
+            os.replace(tmp_path, path)
+        return digest
+
+    def link(self, command, digest):
+        tmp_path = os.path.join(self.abin_path, f".{command}.tmp-{os.getpid()}")
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        os.symlink(os.path.relpath(self.object_path(digest), self.abin_path), tmp_path)
+        os.replace(tmp_path, self.command_path(command))
+
+    def activate(self, command, version):
+        # Point abin/<command> at a version, unless it already does
+        entry = self.commands[command]
+        if entry['current'] != version['hash'] or not os.path.lexists(self.command_path(command)):
+            entry['current'] = version['hash']
+            self.current_versions[command] = version
+            self.link(command, version['hash'])
+            self.save_index()
+        return self.command_path(command)
+
+    def publish(self, command, code, prompt_hash, model, tokens=None, source='generate', save=True):
+        digest = self.write_object(code)
+        version = {
+            'hash': digest,
+            'prompt_hash': prompt_hash,
+            'model': model,
+            'created': time.time(),
+            'tokens': tokens,
+            'options': script_options(code),
+            'source': source,
+        }
+        entry = self.commands.setdefault(command, {'current': None, 'versions': []})
+        entry['versions'].append(version)
+        entry['current'] = digest
+        self.keys[(command, prompt_hash, model)] = version
+        self.current_versions[command] = version
+        self.link(command, digest)
+        if save:
+            self.save_index()
+        logger.debug(f"Published {command} version {digest[:12]} ({source})")
+        return self.command_path(command)
+
+    def versions(self, command):
+        entry = self.commands.get(command)
+        return entry['versions'] if entry else []
+
+    def rollback(self, command, digest=None):
+        # Make an older version current again: the given one, or the one
+        # published before the current version
+        versions = self.versions(command)
+        if not versions:
+            raise KeyError(f"No versions stored for command: {command}")
+        hashes = [version['hash'] for version in versions]
+        if digest is None:
+            position = len(hashes) - 1 - hashes[::-1].index(self.commands[command]['current'])
+            if position == 0:
+                raise ValueError(f"No older version of {command} to roll back to")
+            version = versions[position - 1]
+        else:
+            matches = [version for version in versions if version['hash'].startswith(digest)]
+            if not matches:
+                raise KeyError(f"No version {digest} of command: {command}")
+            version = matches[-1]
+        logger.info(f"Rolling back {command} to version {version['hash'][:12]}")
+        return self.activate(command, version)
@@ -0,0 +1,83 @@
+# Lightweight tracing. A trace id is carried in a context variable, sent
+# along with every kernel request as "trace_id", and every span recorded
+# while it is set is kept in memory as a Chrome trace event ("ph": "X").
+# hamsh writes one command line's spans, its own and the kernel's, as a
+# trace file that chrome://tracing or ui.perfetto.dev can open.
+
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import contextvars
+import weakref
+from collections import deque
+from contextlib import contextmanager
+from hamnix_logger import setup_logger
+
+logger = setup_logger(__name__)
+
+TRACE_ID = contextvars.ContextVar('hamnix_trace_id', default=None)
+MAX_EVENTS = 100000
+
+def new_trace_id():
+    return uuid.uuid4().hex[:16]
+
+def now_us():
+    # Wall clock, so spans from hamsh and the kernel line up
+    return time.time_ns() // 1000
+
+class Tracer:
+    def __init__(self, process_name, max_events=MAX_EVENTS):
+        self.process_name = process_name
+        self.events = deque(maxlen=max_events)
+        # asyncio task -> lane number, so concurrent tasks get their own row
+        # in the viewer instead of overlapping spans on one
+        self.lanes = weakref.WeakKeyDictionary()
+        self.next_lane = 1
+
+    def lane(self):
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        if task is None:
+            return 0
+        if task not in self.lanes:
+            self.lanes[task] = self.next_lane
+            self.next_lane += 1
+        return self.lanes[task]
+
+    @contextmanager
+    def span(self, name, **args):
+        # No-op unless a trace is active. Yields the span's args, so results
+        # known only at the end (token counts, exit status) can be added.
+        trace_id = TRACE_ID.get()
+        if trace_id is None:
+            yield {}
+            return
+        start = now_us()
+        lane = self.lane()
+        try:
+            yield args
+        finally:
+            self.events.append({
+                "name": name, "ph": "X", "ts": start, "dur": now_us() - start,
+                "pid": os.getpid(), "tid": lane, "args": dict(args, trace_id=trace_id),
+            })
+
+    def trace_events(self, trace_id=None):
+        events = [event for event in self.events if trace_id is None or event["args"]["trace_id"] == trace_id]
+        metadata = {"name": "process_name", "ph": "M", "pid": os.getpid(), "tid": 0, "args": {"name": self.process_name}}
+        return [metadata] + events
+
+def write_trace(path, events):
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    os.replace(tmp_path, path)
+    logger.debug(f"Wrote {len(events)} trace events to {path}")
+
+# Shared by everything in this process, named after the program
+tracer = Tracer(os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'python')
@@ -0,0 +1,76 @@
+import os
+import sys
+import ast
+import asyncio
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from hamnix_logger import setup_logger
+
+logger = setup_logger(__name__)
+
+SMOKE_TEST_TIMEOUT = 5
+SMOKE_TEST_MEMORY = 512 * 1024 * 1024
+
+def limit_resources():
+    # Runs in the smoke-tested script's process before exec
+    resource.setrlimit(resource.RLIMIT_CPU, (SMOKE_TEST_TIMEOUT, SMOKE_TEST_TIMEOUT))
+    resource.setrlimit(resource.RLIMIT_AS, (SMOKE_TEST_MEMORY, SMOKE_TEST_MEMORY))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (1024 * 1024, 1024 * 1024))
+
+def check_script(code, timeout=SMOKE_TEST_TIMEOUT):
+    # Runs in a pool process. The script has to parse and answer --help with
+    # exit status 0 from an empty scratch directory, with no stdin, a bare
+    # environment and limits on CPU, memory and file size.
+    # Returns (passed, reason).
+    try:
+        ast.parse(code)
+    except SyntaxError as e:
+        return False, f"syntax error at line {e.lineno}: {e.msg}"
+    with tempfile.TemporaryDirectory(prefix='hamnix-check-') as workdir:
+        path = os.path.join(workdir, 'script.py')
+        with open(path, 'w') as f:
+            f.write(code)
+        try:
+            result = subprocess.run([sys.executable, path, '--help'], cwd=workdir, stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout,
+                                    env={'PATH': os.defpath, 'HOME': workdir, 'TMPDIR': workdir},
+                                    preexec_fn=limit_resources)
+        except subprocess.TimeoutExpired:
+            return False, f"--help did not finish within {timeout}s"
+    if result.returncode != 0:
+        error = result.stderr.decode(errors='replace').strip().splitlines()
+        return False, f"--help exited with status {result.returncode}" + (f": {error[-1]}" if error else "")
+    if not result.stdout.strip():
+        return False, "--help printed nothing"
+    return True, None
+
+class ScriptValidator:
+    # Checks generated scripts in a small process pool, so parsing and smoke
+    # tests of several candidates run in parallel and off the event loop.
+    def __init__(self, max_workers=4, timeout=SMOKE_TEST_TIMEOUT):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.pool = None
+
+    async def check(self, code):
+        if self.pool is None:
+            # forkserver, since forking the kernel would copy the model and
+            # the inference thread along with it
+            self.pool = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context('forkserver'))
+        try:
+            passed, reason = await asyncio.get_running_loop().run_in_executor(self.pool, check_script, code, self.timeout)
+        except BrokenProcessPool:
+            # Start a fresh pool for the next check instead of failing forever
+            logger.error("Script checker process died, restarting the pool")
+            self.pool = None
+            return False, "script checker crashed"
+        logger.debug(f"Script check {'passed' if passed else 'failed: ' + reason}")
+        return passed, reason
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
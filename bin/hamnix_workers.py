@@ -0,0 +1,152 @@
+import json
+import asyncio
+from collections import OrderedDict, deque
+from hamnix_logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Lower numbers are dispatched first
+PRIORITIES = {'interactive': 0, 'background': 1, 'prefetch': 2}
+TASK_PRIORITIES = {'generate_command': 'interactive', 'extend_command': 'background'}
+
+def task_priority(task):
+    # A client can demote a request (e.g. prefetching commands it may need
+    # later) with an explicit priority; otherwise the task type decides.
+    name = task.get('priority') or TASK_PRIORITIES.get(task.get('type'), 'interactive')
+    if name not in PRIORITIES:
+        raise ValueError(f"Unknown priority: {name}")
+    return PRIORITIES[name]
+
+def task_session(task):
+    return task.get('session_id') or task.get('context_id') or 'anonymous'
+
+class QueuedTask:
+    def __init__(self, task, on_progress, priority, session, sequence):
+        self.task = task
+        self.on_progress = on_progress
+        self.priority = priority
+        self.session = session
+        self.sequence = sequence
+        self.future = asyncio.get_running_loop().create_future()
+
+class WorkerPool:
+    # Long-running workers pulling tasks from a bounded priority queue.
+    #
+    # Each priority class keeps one FIFO per session and serves the sessions
+    # round-robin, so a client with many queued tasks only gets every other
+    # slot when someone else is waiting. When the queue is full a new task
+    # replaces the newest task of a lower priority class, or is rejected if
+    # there is none; either way the client gets an error right away instead
+    # of waiting behind work that cannot be served.
+    def __init__(self, execute, num_workers=16, max_queued=64):
+        self.execute = execute
+        self.num_workers = num_workers
+        self.max_queued = max_queued
+        self.queues = [OrderedDict() for _ in PRIORITIES]
+        self.queued = 0
+        self.submitted = 0
+        self.available = None
+        self.workers = []
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.shed = 0
+
+    def start(self):
+        if self.workers:
+            return
+        logger.debug(f"Starting {self.num_workers} workers, queue limit {self.max_queued}")
+        self.available = asyncio.Semaphore(0)
+        self.workers = [asyncio.create_task(self.worker(i)) for i in range(self.num_workers)]
+
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def submit(self, task, on_progress=None):
+        # Returns a future resolved with the task's JSON result
+        self.start()
+        self.submitted += 1
+        item = QueuedTask(task, on_progress, task_priority(task), task_session(task), self.submitted)
+        if self.queued >= self.max_queued:
+            victim = self.shed_candidate(item.priority)
+            if victim is None:
+                self.rejected += 1
+                logger.warning(f"Queue full, rejecting {task.get('type')} from {item.session}")
+                item.future.set_result(self.overloaded(f"{self.queued} tasks queued"))
+                return item.future
+            self.remove(victim)
+            self.shed += 1
+            logger.warning(f"Queue full, shedding {victim.task.get('type')} from {victim.session} for {task.get('type')}")
+            victim.future.set_result(self.overloaded("dropped for higher priority work"))
+        else:
+            self.available.release()
+        self.queues[item.priority].setdefault(item.session, deque()).append(item)
+        self.queued += 1
+        if self.running >= self.num_workers and on_progress:
+            on_progress({"type": "progress", "status": "queued", "position": self.queued})
+        logger.debug(f"Queued {task.get('type')} from {item.session} at priority {item.priority} ({self.queued} queued)")
+        return item.future
+
+    @staticmethod
+    def overloaded(reason):
+        return json.dumps({"error": f"Kernel overloaded ({reason}), try again later"})
+
+    def shed_candidate(self, priority):
+        # The most recently queued task of the lowest priority class that is
+        # below the new task's class
+        for level in range(len(self.queues) - 1, priority, -1):
+            if self.queues[level]:
+                return max((items[-1] for items in self.queues[level].values()), key=lambda item: item.sequence)
+        return None
+
+    def remove(self, item):
+        sessions = self.queues[item.priority]
+        sessions[item.session].remove(item)
+        if not sessions[item.session]:
+            del sessions[item.session]
+        self.queued -= 1
+
+    def next_task(self):
+        for sessions in self.queues:
+            if sessions:
+                session, items = next(iter(sessions.items()))
+                item = items.popleft()
+                # Move the session to the back of its class so the others
+                # get a turn before it is served again
+                del sessions[session]
+                if items:
+                    sessions[session] = items
+                self.queued -= 1
+                return item
+        return None
+
+    async def worker(self, number):
+        while True:
+            await self.available.acquire()
+            item = self.next_task()
+            self.running += 1
+            try:
+                logger.debug(f"Worker {number} running {item.task.get('type')} from {item.session}")
+                result = await self.execute(item.task, item.on_progress)
+            except Exception as e:
+                logger.error(f"Error executing task: {str(e)}")
+                result = json.dumps({"error": str(e)})
+            finally:
+                self.running -= 1
+            self.completed += 1
+            if not item.future.done():
+                item.future.set_result(result)
+
+    def stats(self):
+        return {
+            "workers": self.num_workers,
+            "running": self.running,
+            "queued": {name: sum(len(items) for items in self.queues[level].values()) for name, level in PRIORITIES.items()},
+            "max_queued": self.max_queued,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "shed": self.shed,
+        }
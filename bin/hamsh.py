@@ -3,121 +3,327 @@
 import os
 import sys
 import shlex
+import signal
 import readline
 import asyncio
 import json
+import codecs
 from hamnix_logger import setup_logger
-from hamnix_lib import communicate_with_kernel, ABIN_PATH, extend_script
+from hamnix_lib import communicate_with_kernel, ABIN_PATH, SESSION_ID, extend_script
+from hamnix_forkserver import ForkServerClient
+from hamnix_completion import Completer
+from hamnix_options import OptionIndex
+from hamnix_trace import TRACE_ID, tracer, new_trace_id, write_trace
 
 logger = setup_logger(__name__)
 
+# Started in main() unless HAMSH_FORKSERVER=0
+forkserver = None
+option_index = OptionIndex()
+completer = Completer(ABIN_PATH, option_index)
+# With HAMSH_TRACE=<directory> every command line is traced and written
+# there as <trace id>.json, hamsh's and the kernel's spans together
+TRACE_DIR = os.environ.get('HAMSH_TRACE')
+# Extend-and-rerun rounds per command line, for scripts that keep exiting
+# with status 2
+MAX_EXTEND_RETRIES = 3
+RELAY_CHUNK = 1 << 20
+
+def output_target(file):
+    # The descriptor behind file, for the child to write to directly, or
+    # PIPE when there is none (an io.StringIO, say) and hamsh has to relay
+    try:
+        fd = file.fileno()
+    except (AttributeError, OSError, ValueError):
+        return asyncio.subprocess.PIPE
+    file.flush()
+    return fd
+
 async def stream_output(stream, file):
+    # Relays a child's output to a file object that has no descriptor, in
+    # large chunks rather than line by line
+    buffer = getattr(file, 'buffer', None)
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
     while True:
-        line = await stream.readline()
-        if not line:
+        data = await stream.read(RELAY_CHUNK)
+        if not data:
             break
-        file.buffer.write(line)
-        file.flush()
+        if buffer is not None:
+            buffer.write(data)
+        else:
+            file.write(decoder.decode(data))
+    if buffer is None:
+        file.write(decoder.decode(b'', final=True))
+    file.flush()
+
+class GenerationProgress:
+    # Shows the line the kernel is currently generating, like the old
+    # single-process hamnix did, on stderr so redirected output stays clean.
+    def __init__(self, command):
+        self.command = command
+        self.text = ''
+        self.shown = False
+        self.enabled = sys.stderr.isatty()
 
-async def execute_command(command, args, input_file=None, output_file=None, error_file=None, force_regenerate=False):
-    logger.debug(f"Executing command: {command} with args: {args}")
-    logger.debug(f"Input file: {input_file}, Output file: {output_file}, Error file: {error_file}")
+    def show(self, status):
+        print(f"\r\033[K[{self.command}] {status}", end='', file=sys.stderr, flush=True)
+        self.shown = True
+
+    def __call__(self, frame):
+        if not self.enabled:
+            return
+        if frame.get('type') == 'token':
+            self.text += frame['text']
+            last_line = self.text.split('\n')[-1]
+            self.show(f"{last_line[:50]}{'...' if len(last_line) > 50 else ''}")
+        elif frame.get('type') == 'progress':
+            self.show(f"{frame['status']}...")
+
+    def done(self):
+        if self.shown:
+            print("\r\033[K", end='', file=sys.stderr, flush=True)
+
+async def request_script(message, extend=False, reason=None):
+    progress = GenerationProgress(message['command'])
     try:
-        message = {
-            'type': 'generate_command',
-            'command': command,
-            'args': args,
-            'context_id': 'hamsh',
-            'force_regenerate': force_regenerate
-        }
-        command_path = await communicate_with_kernel(message)
-        logger.debug(f"Received command path from kernel: {command_path}")
-        
-        if not os.path.exists(command_path):
-            logger.warning(f"Command file does not exist: {command_path}. Attempting to regenerate.")
-            message['force_regenerate'] = True
-            command_path = await communicate_with_kernel(message)
-            logger.debug(f"Regenerated command path: {command_path}")
-        
-        if not os.path.exists(command_path):
-            raise FileNotFoundError(f"Command file does not exist: {command_path}")
-        
-        cmd = [command_path] + args
-        logger.debug(f"Full command: {cmd}")
-        
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdin=asyncio.subprocess.PIPE if input_file else None,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            env=os.environ
-        )
-        logger.debug(f"Started subprocess with PID: {process.pid}")
-        
-        # Set up tasks for handling I/O
-        tasks = []
-        if input_file:
-            tasks.append(asyncio.create_task(stream_input(input_file, process.stdin)))
-        tasks.append(asyncio.create_task(stream_output(process.stdout, sys.stdout if not output_file else open(output_file, 'wb'))))
-        tasks.append(asyncio.create_task(stream_output(process.stderr, sys.stderr if not error_file else open(error_file, 'wb'))))
-        
-        # Wait for the process to complete and all I/O to finish
-        await asyncio.gather(process.wait(), *tasks)
-        
-        if process.returncode == 2:
-            logger.info(f"Command '{command}' exited with status 2. Attempting to extend the script.")
-            await extend_script(command, args)
-            # Retry the command after extension
-            return await execute_command(command, args, input_file, output_file, error_file, False)
-        
-        logger.debug(f"Command execution completed with return code: {process.returncode}")
-        return process.returncode
+        if extend:
+            return await extend_script(message['command'], message['args'], on_frame=progress, reason=reason)
+        return await communicate_with_kernel(message, on_frame=progress)
+    finally:
+        progress.done()
+
+async def spawn(command_path, args, stdin=None, stdout=None, stderr=None):
+    # stdin/stdout/stderr: None to inherit, a file descriptor, or
+    # asyncio.subprocess.PIPE (stdout and stderr only)
+    with tracer.span('spawn', command=os.path.basename(command_path), forkserver=forkserver is not None and forkserver.running):
+        return await spawn_process(command_path, args, stdin, stdout, stderr)
+
+async def spawn_process(command_path, args, stdin=None, stdout=None, stderr=None):
+    # Commands are forked from the fork server when it is up, which skips
+    # interpreter startup, stdlib imports and compiling the script
+    if forkserver is not None and forkserver.running:
+        try:
+            return await forkserver.create_subprocess_exec(command_path, *args, stdin=stdin, stdout=stdout, stderr=stderr)
+        except OSError as e:
+            logger.warning(f"Fork server could not run {command_path}, starting a new process: {str(e)}")
+    return await asyncio.create_subprocess_exec(
+        command_path, *args,
+        stdin=stdin,
+        stdout=stdout,
+        stderr=stderr,
+        env=os.environ
+    )
+
+def script_request(command, args, force_regenerate=False):
+    return {
+        'type': 'generate_command',
+        'command': command,
+        'args': args,
+        'context_id': 'hamsh',
+        'session_id': SESSION_ID,
+        'force_regenerate': force_regenerate
+    }
+
+async def resolve_script(command, args, force_regenerate=False):
+    # Path of the script for command, generated by the kernel if needed
+    message = script_request(command, args, force_regenerate)
+    command_path = await request_script(message)
+    logger.debug(f"Received command path from kernel: {command_path}")
+    
+    if not os.path.exists(command_path):
+        logger.warning(f"Command file does not exist: {command_path}. Attempting to regenerate.")
+        message['force_regenerate'] = True
+        command_path = await request_script(message)
+        logger.debug(f"Regenerated command path: {command_path}")
+    
+    if not os.path.exists(command_path):
+        raise FileNotFoundError(f"Command file does not exist: {command_path}")
+    return command_path
+
+async def resolve_scripts(stages, force_regenerate=False):
+    # Every command of the line goes to the kernel at once, so the missing
+    # ones are generated in the same batches rather than one stage after
+    # another, and the pipeline starts after about one generation. Scripts
+    # already in the store come straight back from the kernel's fast path.
+    tasks = {}
+    for command, args, *_ in stages:
+        if command not in tasks:
+            tasks[command] = asyncio.ensure_future(resolve_script(command, args, force_regenerate))
+    try:
+        with tracer.span('resolve', commands=list(tasks)):
+            await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        raise
+    return [tasks[command].result() for command, *_ in stages]
+
+async def extend_scripts(requests, reason):
+    # requests: (command, args) pairs, extended concurrently
+    results = await asyncio.gather(*(request_script(script_request(command, args), extend=True, reason=reason)
+                                     for command, args in requests), return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+def undeclared_options(stages, paths, skip=()):
+    # (command, args) for the stages passing options their script, at the
+    # path the kernel resolved, does not declare; one per command
+    requests = {}
+    for (command, args, *_), path in zip(stages, paths):
+        if command in skip or command in requests:
+            continue
+        unknown = option_index.unknown(path, args)
+        if unknown:
+            logger.info(f"Command '{command}' does not declare {', '.join(unknown)}. Extending the script before running it.")
+            requests[command] = args
+    return list(requests.items())
+
+def parse_redirections(cmd):
+    # Splits a stage's `<`, `>` and `2>` redirections off its arguments
+    command, *args = cmd
+    input_file = output_file = error_file = None
+    
+    if '<' in args:
+        input_index = args.index('<')
+        input_file = args[input_index + 1]
+        args = args[:input_index] + args[input_index + 2:]
+        logger.debug(f"Input redirection detected: {input_file}")
+    
+    if '>' in args:
+        output_index = args.index('>')
+        output_file = args[output_index + 1]
+        args = args[:output_index] + args[output_index + 2:]
+        logger.debug(f"Output redirection detected: {output_file}")
+    
+    if '2>' in args:
+        error_index = args.index('2>')
+        error_file = args[error_index + 1]
+        args = args[:error_index] + args[error_index + 2:]
+        logger.debug(f"Error redirection detected: {error_file}")
+    
+    return command, args, input_file, output_file, error_file
+
+def open_redirect(path, output=True):
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC if output else os.O_RDONLY
+    return os.open(path, flags | os.O_CLOEXEC, 0o666)
+
+async def run_stages(stages, paths):
+    # Starts every stage at once. Each stage's stdout is the write end of an
+    # OS pipe whose read end is the next stage's stdin, so data flows
+    # between the processes without passing through hamsh and a fast
+    # producer blocks on the full pipe buffer. A redirection replaces the
+    # pipe on that side, as in sh, and everything else goes straight to
+    # hamsh's own stdout and stderr. Returns the exit statuses.
+    processes = []
+    # Descriptors the children got copies of; hamsh closes its own once
+    # every stage has started, or readers would never see EOF
+    parent_fds = []
+    try:
+        stdin = None
+        for index, ((command, args, input_file, output_file, error_file), path) in enumerate(zip(stages, paths)):
+            next_stdin = None
+            stdout = output_target(sys.stdout)
+            if index < len(stages) - 1:
+                next_stdin, stdout = os.pipe()
+                parent_fds += [next_stdin, stdout]
+            if input_file:
+                stdin = open_redirect(input_file, output=False)
+                parent_fds.append(stdin)
+            if output_file:
+                stdout = open_redirect(output_file)
+                parent_fds.append(stdout)
+            stderr = output_target(sys.stderr)
+            if error_file:
+                stderr = open_redirect(error_file)
+                parent_fds.append(stderr)
+            process = await spawn(path, args, stdin, stdout, stderr)
+            logger.debug(f"Started stage {index + 1}/{len(stages)} '{command}' with PID: {process.pid}")
+            processes.append(process)
+            stdin = next_stdin
+    except BaseException:
+        for process in processes:
+            try:
+                os.kill(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        raise
+    finally:
+        for fd in parent_fds:
+            os.close(fd)
+    
+    # Only output for a file object without a descriptor is relayed
+    tasks = [stream_output(process.stdout, sys.stdout) for process in processes if process.stdout is not None]
+    tasks += [stream_output(process.stderr, sys.stderr) for process in processes if process.stderr is not None]
+    await asyncio.gather(*(process.wait() for process in processes), *tasks)
+    return [process.returncode for process in processes]
+
+async def traced_command_line(commands, force_regenerate=False, line=None):
+    token = TRACE_ID.set(new_trace_id())
+    trace_id = TRACE_ID.get()
+    try:
+        with tracer.span('command line', line=line):
+            await run_pipeline(commands, force_regenerate)
+    finally:
+        TRACE_ID.reset(token)
+    events = tracer.trace_events(trace_id)
+    try:
+        events += await communicate_with_kernel({'type': 'trace', 'trace_id': trace_id})
     except Exception as e:
-        logger.error(f"An error occurred during command execution: {str(e)}")
-        print(f"An error occurred: {str(e)}", file=sys.stderr)
-        return 1
-
-async def stream_input(input_file, stdin):
-    with open(input_file, 'rb') as f:
-        while True:
-            chunk = f.read(4096)
-            if not chunk:
-                break
-            await stdin.write(chunk)
-    stdin.close()
+        logger.warning(f"Could not fetch kernel spans for trace {trace_id}: {str(e)}")
+    path = os.path.join(TRACE_DIR, f"{trace_id}.json")
+    write_trace(path, events)
+    logger.info(f"Trace written to {path}")
 
 async def run_pipeline(commands, force_regenerate=False):
+    # Returns the exit status of the last stage. Options a script does not
+    # declare get it extended before anything runs. As a fallback for what
+    # that misses, a stage exiting with status 2 (argparse's unknown option)
+    # gets its script extended and the whole pipeline runs again, at most
+    # MAX_EXTEND_RETRIES times.
     logger.debug(f"Running pipeline with commands: {commands}")
-    for i, cmd in enumerate(commands):
-        logger.debug(f"Executing command {i+1}/{len(commands)}: {cmd}")
-        command, *args = cmd
-        input_file = output_file = error_file = None
-        
-        if '<' in args:
-            input_index = args.index('<')
-            input_file = args[input_index + 1]
-            args = args[:input_index] + args[input_index + 2:]
-            logger.debug(f"Input redirection detected: {input_file}")
-        
-        if '>' in args:
-            output_index = args.index('>')
-            output_file = args[output_index + 1]
-            args = args[:output_index] + args[output_index + 2:]
-            logger.debug(f"Output redirection detected: {output_file}")
-        
-        if '2>' in args:
-            error_index = args.index('2>')
-            error_file = args[error_index + 1]
-            args = args[:error_index] + args[error_index + 2:]
-            logger.debug(f"Error redirection detected: {error_file}")
-        
-        exit_code = await execute_command(command, args, input_file, output_file, error_file, force_regenerate)
-        logger.debug(f"Command '{command}' completed with exit code: {exit_code}")
-        
-        if exit_code != 0:
-            logger.warning(f"Command '{command}' failed with exit code {exit_code}")
-            print(f"Command '{command}' failed with exit code {exit_code}", file=sys.stderr)
+    stages = [parse_redirections(cmd) for cmd in commands]
+    # Commands extended up front once already for this line
+    validated = set()
+    for attempt in range(MAX_EXTEND_RETRIES + 1):
+        try:
+            paths = await resolve_scripts(stages, force_regenerate)
+            force_regenerate = False
+            undeclared = undeclared_options(stages, paths, validated)
+            if undeclared:
+                validated.update(command for command, _ in undeclared)
+                try:
+                    with tracer.span('validate', commands=[command for command, _ in undeclared]):
+                        await extend_scripts(undeclared, 'validation')
+                except Exception as e:
+                    logger.warning(f"Could not extend scripts before running them: {str(e)}")
+            with tracer.span('run', commands=[stage[0] for stage in stages]) as span:
+                statuses = await run_stages(stages, paths)
+                span['statuses'] = statuses
+        except Exception as e:
+            logger.error(f"An error occurred during command execution: {str(e)}")
+            print(f"An error occurred: {str(e)}", file=sys.stderr)
+            return 1
+        logger.debug(f"Pipeline completed with exit codes: {statuses}")
+        unknown_options = [(command, args) for (command, args, *_), status in zip(stages, statuses) if status == 2]
+        if not unknown_options or attempt == MAX_EXTEND_RETRIES:
+            break
+        for command, _ in unknown_options:
+            logger.info(f"Command '{command}' exited with status 2. Attempting to extend the script.")
+        try:
+            await extend_scripts(unknown_options, 'exit_status_2')
+        except Exception as e:
+            logger.error(f"Error extending script: {str(e)}")
+            print(f"An error occurred: {str(e)}", file=sys.stderr)
             break
+        logger.debug(f"Running the pipeline again after extending {len(unknown_options)} scripts")
+    
+    exit_code = statuses[-1]
+    if exit_code != 0:
+        command = stages[-1][0]
+        logger.warning(f"Command '{command}' failed with exit code {exit_code}")
+        print(f"Command '{command}' failed with exit code {exit_code}", file=sys.stderr)
+    return exit_code
 
 def parse_command(command_string):
     logger.debug(f"Parsing command string: {command_string}")
@@ -126,27 +332,25 @@ def parse_command(command_string):
     return commands
 
 def command_completer(text, state):
-    logger.debug(f"Command completion requested for: {text}, state: {state}")
-    buffer = readline.get_line_buffer()
-    line = shlex.split(buffer)
-    
-    if not line or len(line) == 1 and not buffer.endswith(' '):
-        # Complete commands
-        options = [cmd for cmd in os.listdir(ABIN_PATH) if cmd.startswith(text)]
-        if state < len(options):
-            logger.debug(f"Returning command completion: {options[state]}")
-            return options[state]
-    elif len(line) > 1 or (len(line) == 1 and buffer.endswith(' ')):
-        # Complete filesystem paths
-        completion = readline.get_completer()(text, state)
-        logger.debug(f"Returning filesystem completion: {completion}")
-        return completion
-    
-    logger.debug("No completion found")
-    return None
+    return completer.complete(readline.get_line_buffer()[:readline.get_begidx()], text, state)
+
+async def start_forkserver():
+    global forkserver
+    if os.environ.get('HAMSH_FORKSERVER', '1') == '0':
+        return
+    try:
+        forkserver = ForkServerClient()
+        await forkserver.start()
+        logger.debug(f"Fork server running at {forkserver.socket_path}")
+    except Exception as e:
+        logger.warning(f"Could not start the fork server, commands will start new processes: {str(e)}")
+        forkserver = None
 
 async def main():
     logger.info("Starting Hamsh - The Hamnix Shell")
+    if TRACE_DIR:
+        os.makedirs(TRACE_DIR, exist_ok=True)
+    await start_forkserver()
     print("Welcome to Hamsh - The Hamnix Shell!")
     print("Type 'exit' to quit. Press Tab for completion.")
     print("Start a command with '!' to force regeneration.")
@@ -183,10 +387,16 @@ async def main():
             try:
                 commands = parse_command(user_input)
                 logger.debug(f"Parsed commands: {commands}")
-                await run_pipeline(commands, force_regenerate)
+                if TRACE_DIR:
+                    await traced_command_line(commands, force_regenerate, user_input)
+                else:
+                    await run_pipeline(commands, force_regenerate)
             except Exception as e:
                 logger.error(f"An error occurred: {str(e)}")
                 print(f"An error occurred: {str(e)}", file=sys.stderr)
 
+    if forkserver is not None:
+        await forkserver.close()
+
 if __name__ == "__main__":
     asyncio.run(main())